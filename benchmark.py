@@ -0,0 +1,392 @@
+"""
+Benchmark the custom readers and the mimetype detection hook.
+
+A synthetic corpus is generated locally (SPEC files of N scans x M columns,
+1-D/2-D/3-D MDA files, images of several formats & sizes, HDF5 & NeXus
+files).  For every file, these stages are timed:
+
+* ``detect``: mimetype detection (``custom.detect_mimetype``)
+* ``construct``: adapter construction (the reader, as in ``config.yml``)
+* ``metadata``: serialization of the metadata of all nodes
+* ``read``: read of all arrays, into memory (as numpy arrays: the HDF5
+  readers give h5py datasets, read only when used)
+
+and the peak (Python) memory of the whole sequence is tracked.  Results
+are saved as JSON so that runs can be compared over time::
+
+    python benchmark.py --output results.json
+    python benchmark.py --compare before.json results.json
+"""
+
+import datetime
+import importlib
+import json
+import mimetypes
+import numpy
+import pathlib
+import platform
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# As configured in config.yml (see config.yml.template).
+MIMETYPES_BY_FILE_EXT = {
+    ".dat": "text/spec_data",
+    ".h5": "application/x-hdf5",
+    ".hdf": "application/x-hdf5",
+    ".mda": "application/x-mda",
+    ".nxs": "application/x-hdf5",
+    ".webp": "image/webp",
+}
+READERS_BY_MIMETYPE = {
+    "application/x-hdf5": "tiled.adapters.hdf5:HDF5Adapter.from_file",
+    "application/x-mda": "registry:read_mda",
+    "image/bmp": "registry:read_image",
+    "image/gif": "registry:read_image",
+    "image/jpeg": "registry:read_image",
+    "image/png": "registry:read_image",
+    "image/tiff": "registry:read_image",
+    "image/webp": "registry:read_image",
+    "image/x-ms-bmp": "registry:read_image",
+    "text/csv": "tiled.adapters.dataframe:DataFrameAdapter.read_csv",
+    "text/spec_data": "registry:read_spec_data",
+}
+STAGES = "detect construct metadata read".split()
+
+# corpus parameters
+SPEC_FILES = [(10, 8), (100, 8), (10, 32), (100, 32)]  # (scans, columns)
+SPEC_POINTS = 50
+MDA_FILES = [(1000,), (100, 100), (20, 20, 20)]  # points, outer dimension first
+IMAGE_FORMATS = "BMP GIF JPEG PNG TIFF WEBP".split()
+IMAGE_SIZES = [256, 1024]  # pixels, square
+HDF5_SHAPES = [(1000,), (100, 256, 256)]
+
+
+def write_spec_file(path, n_scans, n_columns, n_points=SPEC_POINTS):
+    rng = numpy.random.default_rng(n_scans * n_columns)
+    epoch = 1_600_000_000
+    labels = [f"col{c}" for c in range(n_columns - 2)] + ["Monitor", "Detector"]
+    lines = [
+        f"#F {path.name}",
+        f"#E {epoch}",
+        f"#D {time.ctime(epoch)}",
+        f"#C {path.name}  User = benchmark",
+        "#O0 m1  m2  m3  m4",
+        "",
+    ]
+    for scan in range(1, n_scans + 1):
+        lines += [
+            f"#S {scan}  ascan  m1 0 1 {n_points - 1} 1",
+            f"#D {time.ctime(epoch + scan * 60)}",
+            "#T 1  (Seconds)",
+            f"#P0 {scan} 0 0 0",
+            f"#N {n_columns}",
+            "#L " + "  ".join(labels),
+        ]
+        data = rng.random((n_points, n_columns))
+        lines += [" ".join(f"{v:.6g}" for v in row) for row in data]
+        lines.append("")
+    path.write_text("\n".join(lines))
+
+
+def _xdr_int(value):
+    return struct.pack(">i", value)
+
+
+def _xdr_string(text):
+    """XDR counted string, as written by the EPICS saveData."""
+    raw = text.encode()
+    padding = b"\0" * (-len(raw) % 4)
+    return _xdr_int(len(raw)) + _xdr_int(len(raw)) + raw + padding
+
+
+def _mda_scan(dims, offset, rng, n_detectors):
+    """Bytes of an MDA scan (and all its inner scans), starting at ``offset``."""
+    rank, npts = len(dims), dims[0]
+
+    def body(inner_offsets):
+        b = _xdr_int(rank) + _xdr_int(npts) + _xdr_int(npts)
+        b += b"".join(_xdr_int(o) for o in inner_offsets)
+        b += _xdr_string(f"bench:scan{rank}") + _xdr_string(
+            "JAN 01, 2024 00:00:00.000000"
+        )
+        b += _xdr_int(1) + _xdr_int(n_detectors) + _xdr_int(0)  # np, nd, nt
+        b += _xdr_int(0)  # positioner number
+        for text in (
+            f"bench:m{rank}",
+            "motor",
+            "LINEAR",
+            "mm",
+            f"bench:m{rank}.RBV",
+            "readback",
+            "mm",
+        ):
+            b += _xdr_string(text)
+        for d in range(n_detectors):
+            b += _xdr_int(d)
+            for text in (f"bench:det{d}", f"detector {d}", "counts"):
+                b += _xdr_string(text)
+        b += struct.pack(f">{npts}d", *numpy.linspace(0, 1, npts))
+        for d in range(n_detectors):
+            b += struct.pack(f">{npts}f", *rng.random(npts))
+        return b
+
+    if rank == 1:
+        return body([])
+    here = len(body([0] * npts))
+    inner, offsets = b"", []
+    for _ in range(npts):
+        offsets.append(offset + here + len(inner))
+        inner += _mda_scan(dims[1:], offsets[-1], rng, n_detectors)
+    return body(offsets) + inner
+
+
+def write_mda_file(path, dims, n_detectors=4, n_pvs=100):
+    """Write a synApps MDA file with these dimensions (outer first)."""
+    rng = numpy.random.default_rng(len(dims))
+    header = struct.pack(">f", 1.3) + _xdr_int(1) + _xdr_int(len(dims))
+    header += b"".join(_xdr_int(n) for n in dims) + _xdr_int(1)  # isRegular
+    scans = _mda_scan(list(dims), len(header) + 4, rng, n_detectors)
+    extra = _xdr_int(n_pvs)
+    for i in range(n_pvs):
+        extra += _xdr_string(f"bench:pv{i}") + _xdr_string(f"PV number {i}")
+        extra += _xdr_int(34) + _xdr_int(1) + _xdr_string("mm")  # DBR_CTRL_DOUBLE
+        extra += struct.pack(">d", rng.random())
+    p_extra = len(header) + 4 + len(scans)
+    path.write_bytes(header + _xdr_int(p_extra) + scans + extra)
+
+
+def write_image_file(path, size, format):
+    from PIL import Image
+
+    rng = numpy.random.default_rng(size)
+    y, x = numpy.mgrid[0:size, 0:size]
+    pixels = (127 * (1 + numpy.sin(x / 17.0) * numpy.cos(y / 23.0))).astype("uint8")
+    pixels = numpy.stack(
+        [pixels, pixels[::-1], rng.integers(0, 32, pixels.shape, dtype="uint8")],
+        axis=-1,
+    )
+    image = Image.fromarray(pixels, mode="RGB")
+    if format == "GIF":
+        image = image.convert("P")
+    image.save(path, format=format)
+
+
+def write_hdf5_file(path, shape, nexus=False):
+    import h5py
+
+    rng = numpy.random.default_rng(len(shape))
+    with h5py.File(path, "w") as root:
+        if nexus:
+            root.attrs["default"] = "entry"
+            entry = root.create_group("entry")
+            entry.attrs["NX_class"] = "NXentry"
+            entry.attrs["default"] = "data"
+            group = entry.create_group("data")
+            group.attrs["NX_class"] = "NXdata"
+            group.attrs["signal"] = "data"
+        else:
+            group = root.create_group("data")
+        group.create_dataset("data", data=rng.random(shape), chunks=True)
+
+
+def make_corpus(directory):
+    """Write the synthetic corpus, return list of (kind, path)."""
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    corpus = []
+
+    for n_scans, n_columns in SPEC_FILES:
+        path = directory / f"spec_{n_scans}x{n_columns}"  # SPEC: no extension
+        write_spec_file(path, n_scans, n_columns)
+        corpus.append((f"spec {n_scans}x{n_columns}", path))
+    for dims in MDA_FILES:
+        path = directory / f"mda_{len(dims)}d.mda"
+        write_mda_file(path, dims)
+        corpus.append((f"mda {len(dims)}-D", path))
+    for format in IMAGE_FORMATS:
+        for size in IMAGE_SIZES:
+            path = directory / f"image_{size}.{format.lower()}"
+            write_image_file(path, size, format)
+            corpus.append((f"{format.lower()} {size}", path))
+    for shape in HDF5_SHAPES:
+        for nexus in (False, True):
+            label = "nexus" if nexus else "hdf5"
+            path = directory / f"{label}_{len(shape)}d"  # detected from content
+            write_hdf5_file(path, shape, nexus=nexus)
+            corpus.append((f"{label} {len(shape)}-D", path))
+    return corpus
+
+
+def import_object(colon_path):
+    module_name, _, attrs = colon_path.partition(":")
+    obj = importlib.import_module(module_name)
+    for attr in attrs.split("."):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def guess_mimetype(path):
+    """Mimetype from the file extension, as tiled does before the hook."""
+    for i in range(len(path.suffixes)):
+        ext = "".join(path.suffixes[i:])
+        if ext in MIMETYPES_BY_FILE_EXT:
+            return MIMETYPES_BY_FILE_EXT[ext]
+    return mimetypes.guess_type(str(path))[0]
+
+
+def walk(node):
+    """All nodes of an adapter tree."""
+    yield node
+    if node.structure_family == "node":
+        for _key, child in node.items():
+            yield from walk(child)
+
+
+def process(path):
+    """Run all the stages for one file; return (mimetype, times, errors)."""
+    from custom import detect_mimetype
+    from tiled.utils import safe_json_dump
+
+    times, errors = {}, {}
+
+    t0 = time.perf_counter()
+    mimetype = detect_mimetype(path, guess_mimetype(path))
+    times["detect"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    adapter = import_object(READERS_BY_MIMETYPE[mimetype])(str(path))
+    nodes = list(walk(adapter))
+    times["construct"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for node in nodes:
+        try:
+            safe_json_dump(dict(node.metadata))
+        except Exception as exc:
+            errors["metadata"] = repr(exc)
+    times["metadata"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for node in nodes:
+        if node.structure_family == "array":
+            numpy.asarray(node.read())
+    times["read"] = time.perf_counter() - t0
+
+    return mimetype, times, errors
+
+
+def benchmark(corpus, repeat=3):
+    """Best time of ``repeat`` runs of every stage, for every file."""
+    results = []
+    for kind, path in corpus:
+        best = {}
+        for _ in range(repeat):
+            mimetype, times, errors = process(path)
+            for stage, t in times.items():
+                best[stage] = min(t, best.get(stage, t))
+
+        tracemalloc.start()
+        process(path)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results.append(
+            dict(
+                kind=kind,
+                file=path.name,
+                size=path.stat().st_size,
+                mimetype=mimetype,
+                seconds=best,
+                peak_memory=peak,
+                errors=errors,
+            )
+        )
+    return results
+
+
+def environment():
+    versions = {}
+    for name in "h5py numpy PIL punx spec2nexus tiled".split():
+        try:
+            versions[name] = importlib.import_module(name).__version__
+        except (ImportError, AttributeError):
+            versions[name] = None
+    return dict(
+        date=datetime.datetime.now().isoformat(sep=" ", timespec="seconds"),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        versions=versions,
+    )
+
+
+def summary_table(results):
+    import pyRestTable
+
+    table = pyRestTable.Table()
+    table.labels = (
+        ["kind", "bytes"] + [f"{s},ms" for s in STAGES] + ["peak,MB", "errors"]
+    )
+    for result in results:
+        table.addRow(
+            [result["kind"], result["size"]]
+            + [f"{1000 * result['seconds'][s]:.2f}" for s in STAGES]
+            + [f"{result['peak_memory'] / 2**20:.1f}", ", ".join(result["errors"])]
+        )
+    return table
+
+
+def compare_table(before, after):
+    import pyRestTable
+
+    table = pyRestTable.Table()
+    table.labels = "kind stage before,ms after,ms after/before".split()
+    previous = {r["kind"]: r for r in before["results"]}
+    for result in after["results"]:
+        old = previous.get(result["kind"])
+        if old is None:
+            continue
+        for stage in STAGES:
+            t0, t1 = old["seconds"][stage], result["seconds"][stage]
+            ratio = f"{t1 / t0:.2f}" if t0 > 0 else "-"
+            table.addRow(
+                (result["kind"], stage, f"{1000 * t0:.2f}", f"{1000 * t1:.2f}", ratio)
+            )
+    return table
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--corpus", help="directory for the synthetic corpus (default: temporary)"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="best of this many runs")
+    parser.add_argument("--output", help="save results to this JSON file")
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two JSON files"
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        before, after = [json.loads(pathlib.Path(f).read_text()) for f in args.compare]
+        print(compare_table(before, after))
+        return
+
+    sys.path.insert(0, str(pathlib.Path(__file__).parent))
+    with tempfile.TemporaryDirectory() as tempdir:
+        corpus = make_corpus(args.corpus or tempdir)
+        results = benchmark(corpus, repeat=args.repeat)
+    print(summary_table(results))
+
+    if args.output:
+        report = dict(environment=environment(), repeat=args.repeat, results=results)
+        pathlib.Path(args.output).write_text(json.dumps(report, indent=2))
+        print(f"results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
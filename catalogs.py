@@ -0,0 +1,205 @@
+"""
+The databroker (MongoDB) catalogs and file trees of the server configuration.
+
+For server-side features that query the run documents (or files) directly.
+"""
+
+from server import CONFIG_FILE
+import datetime
+import functools
+import logging
+import os
+import pathlib
+
+CONNECT_TIMEOUT = 10  # seconds, to find (or connect to) a MongoDB server
+FILES_TREE = "files"
+MONGO_TREE = "databroker.mongo_normalized:Tree.from_uri"
+SOCKET_TIMEOUT = 120  # seconds, for any one MongoDB operation
+
+logger = logging.getLogger(__name__)
+
+
+def read_config(config_file=None):
+    from tiled.config import parse_configs
+
+    return parse_configs(config_file or CONFIG_FILE)
+
+
+@functools.lru_cache(maxsize=None)
+def mongo_catalogs(config_file=None):
+    """Dictionary of {path: MongoDB uri} of the catalogs in the configuration."""
+    return {
+        tree["path"].strip("/"): tree["args"]["uri"]
+        for tree in read_config(config_file).get("trees", [])
+        if tree.get("tree") == MONGO_TREE
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def file_trees(config_file=None):
+    """Dictionary of {path: (directory, key_from_filename)} of the file trees."""
+    from tiled.utils import import_object
+
+    config_file = pathlib.Path(config_file or CONFIG_FILE)
+    trees = {}
+    for tree in read_config(config_file).get("trees", []):
+        if tree.get("tree") != FILES_TREE:
+            continue
+        args = tree.get("args", {})
+        directory = config_file.parent / args["directory"]  # unless absolute
+        key_from_filename = import_object(
+            args.get("key_from_filename", "tiled.adapters.files:strip_suffixes")
+        )
+        trees[tree["path"].strip("/")] = (directory.resolve(), key_from_filename)
+    return trees
+
+
+@functools.lru_cache(maxsize=None)
+def file_tree_directories():
+    """{directory: tree path} of the file trees, none without a configuration."""
+    try:
+        trees = file_trees()
+    except Exception as exc:  # such as benchmark.py, no config.yml
+        logger.info("no file trees: %s", exc)
+        return {}
+    return {directory: tree for tree, (directory, _key) in trees.items()}
+
+
+def tree_of(filename):
+    """``(tree path, directory)`` of the file tree with this file, or ``None``."""
+    filename = pathlib.Path(filename).resolve()
+    for directory, tree in file_tree_directories().items():
+        if directory in filename.parents:
+            return tree, directory
+    return None
+
+
+def node_path(filename):
+    """Path of the node of this file (as ``tree/sub/key``), or ``None``."""
+    filename = pathlib.Path(filename).resolve()
+    for tree, (directory, key_from_filename) in file_trees().items():
+        if directory in filename.parents:
+            parts = filename.relative_to(directory).parts
+            return "/".join([tree, *parts[:-1], key_from_filename(parts[-1])])
+    return None
+
+
+def file_of(path):
+    """The file of this node path (or of a node within it), or ``None``."""
+    tree, *segments = path.strip("/").split("/")
+    if tree not in file_trees():
+        return None
+    directory, key_from_filename = file_trees()[tree]
+    for segment in segments:
+        if segment in ("", ".", ".."):
+            return None
+        if (directory / segment).is_dir():
+            directory = directory / segment  # directories keep their name
+            continue
+        with os.scandir(directory) as items:
+            for item in items:
+                if item.is_file() and key_from_filename(item.name) == segment:
+                    return pathlib.Path(item.path)
+        return None
+    return None  # a directory
+
+
+@functools.lru_cache(maxsize=None)
+def mongo_client(uri):
+    import pymongo
+
+    return pymongo.MongoClient(
+        uri,
+        connectTimeoutMS=1000 * CONNECT_TIMEOUT,
+        serverSelectionTimeoutMS=1000 * CONNECT_TIMEOUT,
+        socketTimeoutMS=1000 * SOCKET_TIMEOUT,
+    )
+
+
+def access_check(scopes=("read:metadata",)):
+    """
+    Route dependency: may the client read this catalog (or file tree)?
+
+    The client is authenticated as for tiled's own routes (401 without
+    credentials, unless the server is public).  Gives a function of a path
+    that checks it as tiled's ``SecureEntry`` does (access policy).
+    """
+    from fastapi import Depends
+    from fastapi import HTTPException
+    from fastapi import Request
+    from fastapi import Security
+    from tiled.server.authentication import get_current_principal
+    from tiled.server.dependencies import SecureEntry
+    from tiled.server.dependencies import get_root_tree
+
+    check = SecureEntry(scopes=list(scopes)).dependency
+
+    def readable(
+        request: Request,
+        principal=Depends(get_current_principal),
+        root_tree=Depends(get_root_tree),
+    ):
+        def inner(path):
+            try:
+                check(path, request, principal=principal, root_tree=root_tree)
+            except HTTPException:
+                return False
+            return True
+
+        return inner
+
+    return Security(readable, scopes=list(scopes))
+
+
+def database(catalog):
+    """The MongoDB database of this catalog (``KeyError`` if not configured)."""
+    uri = mongo_catalogs()[catalog]
+    return mongo_client(uri).get_default_database()
+
+
+def run_start_filter(since=None, until=None, text=[], text_case=[], **keys):
+    """
+    MongoDB filter of run_start documents, as ``utils.get_tiled_runs``.
+
+    ``since`` & ``until`` are ISO8601 (start time ``>= since`` and ``< until``).
+    All ``text`` (or all ``text_case``) phrases must be found.
+    """
+    from utils import iso2time
+
+    query = dict(keys)
+    if since is not None or until is not None:
+        query["time"] = {}
+        if since is not None:
+            query["time"]["$gte"] = iso2time(since)
+        if until is not None:
+            query["time"]["$lt"] = iso2time(until)
+    if len(text) > 0 and len(text_case) > 0:
+        raise ValueError("Use either 'text' or 'text_case', not both.")
+    phrases = list(text) + list(text_case)
+    if len(phrases) > 0:
+        query["$text"] = {
+            "$search": " ".join(f'"{phrase}"' for phrase in phrases),
+            "$caseSensitive": len(text_case) > 0,
+        }
+    return query
+
+
+def run_summary(start, stop=None):
+    """Short summary of a run (as the columns of ``utils.run_summary_table``)."""
+    stop = stop or {}  # rare case of no stop document!
+    t0 = start.get("time")
+    summary = dict(
+        uid=start["uid"],
+        scan_id=start.get("scan_id"),
+        plan_name=start.get("plan_name"),
+        num_points=start.get("num_points"),
+        time=t0,
+        datetime=None,
+        exit_status=stop.get("exit_status"),
+        duration=None,
+    )
+    if t0 is not None:
+        summary["datetime"] = datetime.datetime.fromtimestamp(t0).isoformat(sep=" ")
+        if stop.get("time") is not None:
+            summary["duration"] = stop["time"] - t0
+    return summary
@@ -2,45 +2,58 @@
 Custom handling for data file types not recognized by tiled.
 
 https://blueskyproject.io/tiled/how-to/read-custom-formats.html
+
+The file formats are recognized by the signatures of ``registry.py``.
+Heavy packages (h5py, hdf5plugin, punx, spec2nexus, ...) are imported
+only when a file of their format is found, not when the server starts.
+The routes that report files as they are seen (``events.file_changed``,
+``facets.add_file``) are added to ``file_hooks`` by ``server.py``: the
+readers do not import the server.
 """
 
-from punx.utils import isHdf5FileObject
-from punx.utils import isNeXusFile
-from spec2nexus.spec import is_spec_file_with_header
-import h5py
-import hdf5plugin
+import exclude
+import metrics
 import pathlib
+import registry
+import shared
+import unrecognized
 
-
-FILE_OF_UNRECOGNIZED_FILE_TYPES = "/tmp/unrecognized_files.txt"
+file_hooks = []  # called with (filename, mimetype) of each file, not excluded
 
 
 def isHdf5(filename):
+    from punx.utils import isHdf5FileObject
+    import h5py
+
     try:
         with h5py.File(filename, "r") as fp:
             return isHdf5FileObject(fp)
-    except Exception:
-        pass
+    except Exception as exc:
+        metrics.count("probe_failures", probe="isHdf5", exception=type(exc).__name__)
     return False
 
 
-def isNeXus(filename):
-    try:
-        return isNeXusFile(filename)
-    except Exception:
-        pass
-    return False
-
+@metrics.timed("detect")
+def detect_mimetype(filename, mimetype):
+    mimetype = _detect_mimetype(pathlib.Path(filename), mimetype)
+    if mimetype != exclude.EXCLUDED:
+        for hook in file_hooks:
+            hook(filename, mimetype)
+    return mimetype
 
-mimetype_table = {
-    is_spec_file_with_header: "text/spec_data",  # spec2nexus.spec.is_spec_file_with_header
-    isNeXus: "application/x-hdf5",  # punx.utils.isNeXusFile
-    isHdf5: "application/x-hdf5",  # punx.utils.isHdf5FileObject
-}
 
+def _detect_mimetype(filename, mimetype):
+    if exclude.excluded(filename, mimetype):
+        return exclude.EXCLUDED
+    if filename.name == "README":
+        return "text/readme"
+    known = unrecognized.known(filename)
+    if known is not None:
+        # seen before, unchanged, skip the probes
+        if exclude.excluded_mimetype(filename, known):
+            return exclude.EXCLUDED
+        return known
 
-def detect_mimetype(filename, mimetype):
-    filename = pathlib.Path(filename)
     if "/.log" in str(filename).lower():
         mimetype = "text/plain"
     elif ".log" in filename.name.lower():
@@ -48,18 +61,17 @@ def detect_mimetype(filename, mimetype):
 
     if mimetype is None:
         # When tiled has not already recognized the mimetype.
-        mimetype = "text/csv"  # the default
-        for tester, mtype in mimetype_table.items():
-            # iterate through our set of known types
-            if tester(filename):
-                mimetype = mtype
-                break
-    if filename.name == "README":
-        mimetype = "text/readme"
-
-    if mimetype is None:
-        with open(FILE_OF_UNRECOGNIZED_FILE_TYPES, "a") as fp:
-            # TODO: What's the point of writing mimetype here? It's `None`!
-            fp.write(f"{mimetype}  {filename}\n")
+        detected = shared.detected(filename)  # by another worker
+        if detected is None:
+            detected = registry.detect(filename)  # signatures, no heavy imports
+            shared.remember(filename, detected or shared.UNRECOGNIZED)
+        if detected in (None, shared.UNRECOGNIZED):
+            mimetype = "text/csv"  # the default
+            unrecognized.record(filename, "unrecognized", mimetype)
+        else:
+            mimetype = detected
 
+    if exclude.excluded_mimetype(filename, mimetype):
+        return exclude.EXCLUDED
+    registry.prepare(mimetype)  # import what its reader needs, once
     return mimetype
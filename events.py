@@ -0,0 +1,346 @@
+"""
+Push notifications of new runs and new files, as Server-Sent Events.
+
+Instead of polling (count, then a page of the most recent runs), a client
+subscribes once and receives:
+
+* ``start``: a new run in a databroker catalog
+* ``stop``: a run has ended (its summary now has ``exit_status`` & ``duration``)
+* ``file``: a file ``added`` to (or ``modified`` in) a file tree
+
+Each catalog is watched by one thread, shared by all its subscribers.  It
+uses a MongoDB change stream (which needs a replica set) or, when change
+streams are not available, polls for new documents by ``_id`` every
+``POLL_INTERVAL`` seconds.  Files are reported by the mimetype detection
+hook (``custom.detect_mimetype``), which tiled calls for each new or
+modified file of a watched directory.
+
+The last ``BUFFER_SIZE`` events are kept: a client that reconnects (with
+the ``Last-Event-ID`` header, as browsers do) receives those it missed.
+With several worker processes, a client may reconnect to another worker:
+the events then go through the shared store (see ``shared.py``), whose
+ids are those of all workers, and each worker sends them to its clients
+(within ``FOLLOW_INTERVAL`` seconds).  One worker watches each catalog.
+Served (see ``server.py``), to clients that may read the catalog (or, for
+files, only of the file trees they may read)::
+
+    /api/v1/events/runs/{catalog}
+    /api/v1/events/runs/{catalog}?key=plan_name:take_image
+    /api/v1/events/files
+    /api/v1/events/files?prefix=files/2023
+
+See ``utils.get_run_events()`` and ``utils.get_file_events()`` for clients.
+"""
+
+from fastapi import APIRouter
+from fastapi import Header
+from fastapi import HTTPException
+from fastapi import Query
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from tiled.server.dependencies import SecureEntry
+from typing import List
+import asyncio
+import catalogs
+import collections
+import logging
+import orjson
+import pathlib
+import shared
+import threading
+import time
+
+BUFFER_SIZE = 1000  # events kept for clients that reconnect
+FOLLOW_INTERVAL = 0.5  # seconds, events of the shared store (several workers)
+HEARTBEAT = 15  # seconds, comment line sent when there are no events
+POLL_INTERVAL = 2  # seconds, when there is no change stream
+QUEUE_SIZE = 1000  # per subscriber, oldest events dropped beyond
+RETRY = 5  # seconds, client waits before it reconnects
+RUN_COLLECTIONS = ("run_start", "run_stop")
+
+logger = logging.getLogger(__name__)
+watchers = {}  # catalog: RunWatcher
+file_events = None  # Broadcaster, once the server has started
+_lock = threading.Lock()
+_seen_files = set()  # files reported by the hook, since the initial scan
+
+router = APIRouter()
+
+
+class Broadcaster:
+    """
+    Send each event to all subscribers (asyncio queues), from any thread.
+
+    With several workers, the events of the ``stream`` go through the
+    shared store, and are sent by the ``follow()`` thread.
+    """
+
+    def __init__(self, size=BUFFER_SIZE, stream=None):
+        self.events = collections.deque(maxlen=size)  # (id, event, document)
+        self.last_id = 0
+        self.subscribers = set()  # (loop, queue)
+        self._lock = threading.Lock()
+        self.stream = stream if shared.ENABLED else None
+        if self.stream is not None:
+            self.last_id = max(0, shared.last_event_id(self.stream) - size)
+            threading.Thread(target=self.follow, daemon=True).start()
+
+    def publish(self, event, document=None, key=None):
+        """
+        Send the event; ``document`` is what subscribers' filters match.
+
+        Through the shared store, an event is kept once for its ``key``
+        (when several workers publish it).
+        """
+        if self.stream is not None:
+            shared.add_event(self.stream, key, dict(event=event, document=document))
+        else:
+            self.send(None, event, document)
+
+    def follow(self):
+        """Send the events of the shared store, as they are added (in a thread)."""
+        while True:
+            try:
+                for event_id, content in shared.events_after(self.stream, self.last_id):
+                    self.send(event_id, content["event"], content["document"])
+            except Exception as exc:
+                logger.warning("events of %r: %s", self.stream, exc)
+            time.sleep(FOLLOW_INTERVAL)
+
+    def send(self, event_id, event, document):
+        """Send to the subscribers, with this id (or the next one)."""
+        with self._lock:
+            self.last_id = self.last_id + 1 if event_id is None else event_id
+            item = (self.last_id, event, document)
+            self.events.append(item)
+            subscribers = list(self.subscribers)
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(_put, queue, item)
+
+    def subscribe(self, loop, last_event_id=None):
+        """New queue of events; first those after ``last_event_id``, if given."""
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        with self._lock:
+            if last_event_id is not None:
+                for item in self.events:
+                    if item[0] > last_event_id:
+                        _put(queue, item)
+            self.subscribers.add((loop, queue))
+        return queue
+
+    def unsubscribe(self, loop, queue):
+        with self._lock:
+            self.subscribers.discard((loop, queue))
+
+
+def _put(queue, item):
+    if queue.full():
+        queue.get_nowait()  # a slow client misses the oldest events
+    queue.put_nowait(item)
+
+
+class RunWatcher:
+    """New & ended runs of one catalog, in a thread."""
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.broadcaster = Broadcaster(stream=f"runs/{catalog}")
+        self.method = None  # "change stream" or "polling"
+        self.resume_token = None
+        self.last = None  # {collection: _id}, when polling
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        from pymongo.errors import OperationFailure
+
+        db = catalogs.database(self.catalog)
+        while True:
+            if not shared.leader(f"events-{self.catalog.replace('/', '_')}"):
+                time.sleep(POLL_INTERVAL)  # another worker watches
+                continue
+            try:
+                if self.method != "polling":
+                    self.watch(db)
+                else:
+                    self.poll(db)
+            except OperationFailure as exc:
+                if self.method is None:
+                    # such as: "$changeStream stage is only supported on replica sets"
+                    logger.info("events of %r: polling (%s)", self.catalog, exc)
+                    self.method = "polling"
+                else:
+                    logger.warning("events of %r: %s", self.catalog, exc)
+                    self.resume_token = None  # might have expired
+                    time.sleep(POLL_INTERVAL)
+            except Exception as exc:
+                logger.warning("events of %r: %s", self.catalog, exc)
+                time.sleep(POLL_INTERVAL)
+
+    def watch(self, db):
+        """Follow the change stream of the run collections."""
+        pipeline = [
+            {
+                "$match": {
+                    "operationType": "insert",
+                    "ns.coll": {"$in": list(RUN_COLLECTIONS)},
+                }
+            }
+        ]
+        with db.watch(pipeline, resume_after=self.resume_token) as stream:
+            self.method = "change stream"
+            for change in stream:
+                self.publish(db, change["ns"]["coll"], change["fullDocument"])
+                self.resume_token = stream.resume_token
+
+    def poll(self, db):
+        """Follow the run collections by ``_id`` (always indexed)."""
+        if self.last is None:  # start from the most recent documents
+            self.last = {}
+            for name in RUN_COLLECTIONS:
+                newest = db[name].find_one({}, {"_id": 1}, sort=[("_id", -1)])
+                self.last[name] = None if newest is None else newest["_id"]
+        last = self.last
+        while True:
+            time.sleep(POLL_INTERVAL)
+            for name in RUN_COLLECTIONS:
+                query = {} if last[name] is None else {"_id": {"$gt": last[name]}}
+                for doc in db[name].find(query).sort("_id", 1):
+                    self.publish(db, name, doc)
+                    last[name] = doc["_id"]
+
+    def publish(self, db, collection, doc):
+        if collection == "run_start":
+            start, stop = doc, None
+        else:
+            start, stop = db["run_start"].find_one({"uid": doc["run_start"]}), doc
+            if start is None:
+                return
+        event = dict(
+            type=collection.split("_")[1],  # start or stop
+            catalog=self.catalog,
+            run=catalogs.run_summary(start, stop),
+        )
+        start.pop("_id", None)
+        self.broadcaster.publish(event, start, key=f"{collection}/{doc['uid']}")
+
+
+def run_watcher(catalog):
+    """The (started) watcher of this catalog."""
+    with _lock:
+        watcher = watchers.get(catalog)
+        if watcher is None:
+            watcher = watchers[catalog] = RunWatcher(catalog)
+            watcher.start()
+    return watcher
+
+
+@router.on_event("startup")
+def start_file_events():
+    # After the initial scan of the directories: later calls are changes.
+    global file_events
+
+    file_events = Broadcaster(stream="files")
+
+
+def file_changed(filename, mimetype):
+    """Called by the mimetype detection hook, for each new or modified file."""
+    filename = pathlib.Path(filename).resolve()
+    change = "modified" if filename in _seen_files else "added"
+    _seen_files.add(filename)
+    if file_events is None:
+        return  # initial scan
+    path = catalogs.node_path(filename)
+    if path is None:
+        return
+    try:
+        stat = filename.stat()
+    except OSError:
+        return
+    event = dict(
+        type="file",
+        change=change,
+        path=path,
+        mimetype=mimetype,
+        size=stat.st_size,
+        mtime=stat.st_mtime,
+    )
+    key = f"{path}/{stat.st_mtime_ns}/{stat.st_size}"  # same in all workers
+    file_events.publish(event, dict(path=path), key=key)
+
+
+async def event_stream(request, broadcaster, last_event_id=None, match=None):
+    """Server-Sent Events, as they are published."""
+    loop = asyncio.get_running_loop()
+    queue = broadcaster.subscribe(loop, last_event_id)
+    try:
+        yield f"retry: {RETRY * 1000}\n\n"
+        while not await request.is_disconnected():
+            try:
+                event_id, event, document = await asyncio.wait_for(
+                    queue.get(), HEARTBEAT
+                )
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if match is None or match(document):
+                data = orjson.dumps(event, default=str).decode()
+                yield f"id: {event_id}\nevent: {event['type']}\ndata: {data}\n\n"
+    finally:
+        broadcaster.unsubscribe(loop, queue)
+
+
+def sse_response(stream):
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# {path}: the catalog, checked by SecureEntry as for tiled's own routes
+@router.get("/events/runs/{path}")
+def run_events(
+    path: str,
+    request: Request,
+    key: List[str] = Query([], description="name:value, of the start document"),
+    last_event_id: int = Header(None),
+    entry=SecureEntry(scopes=["read:metadata"]),
+):
+    from federated import parse_keys
+
+    catalog = path
+    if catalog not in catalogs.mongo_catalogs():
+        raise HTTPException(status_code=404, detail=f"No databroker catalog {catalog!r}")
+    try:
+        keys = parse_keys(key)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+    def match(start):
+        return all(start.get(k) == v for k, v in keys.items())
+
+    broadcaster = run_watcher(catalog).broadcaster
+    return sse_response(event_stream(request, broadcaster, last_event_id, match))
+
+
+@router.get("/events/files")
+def file_tree_events(
+    request: Request,
+    prefix: str = Query("", description="node path, such as files/2023"),
+    last_event_id: int = Header(None),
+    readable=catalogs.access_check(),
+):
+    trees = [tree for tree in catalogs.file_trees() if readable(tree)]
+    if file_events is None or len(trees) == 0:
+        raise HTTPException(status_code=404, detail="No file trees")
+    prefix = prefix.strip("/")
+
+    def match(document):
+        path = document["path"]
+        if not any(path.startswith(tree + "/") for tree in trees):
+            return False
+        return prefix == "" or path == prefix or path.startswith(prefix + "/")
+
+    return sse_response(event_stream(request, file_events, last_event_id, match))
@@ -0,0 +1,158 @@
+"""
+Exclude files from the file tree, before mimetype detection and reading.
+
+The rules (in ``exclude.yml``, or the file named by environment variable
+``TILED_EXCLUDE_RULES``) match by file name (``glob``), by ``mimetype``,
+or by size (``smaller_than``, ``larger_than``, in bytes)::
+
+    include:            # never excluded, even if an exclude rule matches
+      - glob: "*.xml.dat"
+    exclude:
+      - glob: "*.pyc"
+      - glob: "scratch/*"    # with a "/", the path in the file tree
+      - mimetype: text/xml
+      - smaller_than: 1      # empty files
+
+``custom.detect_mimetype`` returns ``EXCLUDED`` for an excluded file.
+There is no reader for that mimetype, so tiled skips the file: no
+adapter is built and it does not appear in listings.  A ``glob`` with a
+"/" is matched against the path of the file relative to the directory of
+its file tree (``config.yml``), or at any depth for a file outside the file
+trees.  The number of (distinct) files excluded by each rule is served
+(see ``reader_routes.py``)::
+
+    /api/v1/excluded
+"""
+
+import catalogs
+import collections
+import fnmatch
+import metrics
+import os
+import pathlib
+import re
+import threading
+import warnings
+import yaml
+
+ROOT = pathlib.Path(__file__).parent
+RULES_FILE = pathlib.Path(os.environ.get("TILED_EXCLUDE_RULES", ROOT / "exclude.yml"))
+EXCLUDED = "application/x-tiled-excluded"  # no reader has this mimetype
+
+# tiled warns about every file it skips, not useful for these
+warnings.filterwarnings("ignore", message=f".*recognized as mimetype {EXCLUDED}")
+
+_lock = threading.Lock()
+_files = collections.defaultdict(set)  # rule: files excluded
+
+
+def rule_label(rule):
+    return ", ".join(f"{k}={v}" for k, v in rule.items())
+
+
+class RuleSet:
+    """Compiled rules of one kind (include or exclude)."""
+
+    def __init__(self, rules):
+        self.rules = rules or []
+        self.names, self.paths, self.mimetypes = [], [], {}
+        self.smaller_than, self.larger_than = None, None
+        for rule in self.rules:
+            label = rule_label(rule)
+            glob = rule.get("glob")
+            if glob is not None and "/" in glob:
+                glob = glob.lstrip("/")
+                relative = re.compile(fnmatch.translate(glob))
+                anywhere = re.compile(fnmatch.translate(f"*/{glob}"))
+                self.paths.append((relative, anywhere, label))
+            elif glob is not None:
+                self.names.append((re.compile(fnmatch.translate(glob)), label))
+            if "mimetype" in rule:
+                self.mimetypes[rule["mimetype"]] = label
+            if "smaller_than" in rule:
+                self.smaller_than = (int(rule["smaller_than"]), label)
+            if "larger_than" in rule:
+                self.larger_than = (int(rule["larger_than"]), label)
+
+    def match_mimetype(self, mimetype):
+        return self.mimetypes.get(mimetype)
+
+    def match(self, filename, mimetype):
+        """Label of the first matching rule, or ``None``."""
+        for pattern, label in self.names:
+            if pattern.match(filename.name):
+                return label
+        if len(self.paths) > 0:
+            found = catalogs.tree_of(filename)
+            if found is not None:
+                path = str(filename.resolve().relative_to(found[1]))
+            for relative, anywhere, label in self.paths:
+                if found is not None and relative.match(path):
+                    return label
+                if found is None and anywhere.match(str(filename)):
+                    return label
+        label = self.mimetypes.get(mimetype)
+        if label is not None:
+            return label
+        if self.smaller_than is not None or self.larger_than is not None:
+            try:
+                size = os.stat(filename).st_size
+            except OSError:
+                return None
+            if self.smaller_than is not None and size < self.smaller_than[0]:
+                return self.smaller_than[1]
+            if self.larger_than is not None and size > self.larger_than[0]:
+                return self.larger_than[1]
+        return None
+
+
+def load_rules(rules_file=RULES_FILE):
+    try:
+        rules = yaml.safe_load(pathlib.Path(rules_file).read_text()) or {}
+    except FileNotFoundError:
+        rules = {}
+    return RuleSet(rules.get("include")), RuleSet(rules.get("exclude"))
+
+
+def _excluded(filename, label):
+    """Count the file (once, even if seen again by a rescan)."""
+    filename = str(filename)
+    with _lock:
+        new = filename not in _files[label]
+        _files[label].add(filename)
+    if new:
+        metrics.count("excluded", rule=label)
+    return True
+
+
+def excluded(filename, mimetype):
+    """Is this file excluded?  (Before mimetype detection.)"""
+    filename = pathlib.Path(filename)
+    if include_rules.match(filename, mimetype) is not None:
+        return False
+    label = exclude_rules.match(filename, mimetype)
+    return False if label is None else _excluded(filename, label)
+
+
+def excluded_mimetype(filename, mimetype):
+    """Is this file excluded by its (detected) mimetype?"""
+    label = exclude_rules.match_mimetype(mimetype)
+    if label is None:
+        return False
+    if include_rules.match(pathlib.Path(filename), mimetype) is not None:
+        return False
+    return _excluded(filename, label)
+
+
+def excluded_counts():
+    """The rules, and the number of files excluded by each."""
+    with _lock:
+        counts = {label: len(files) for label, files in _files.items()}
+    return dict(
+        rules=dict(include=include_rules.rules, exclude=exclude_rules.rules),
+        counts=counts,
+        total=sum(counts.values()),
+    )
+
+
+include_rules, exclude_rules = load_rules()
@@ -0,0 +1,288 @@
+"""
+Counts of the runs (or files) of a catalog, by facet, in one response.
+
+For dashboards and usage reports, instead of downloading the metadata of
+all runs to count them.  For a databroker catalog, one MongoDB aggregation
+pipeline (``$facet``) counts the runs that match the search terms of
+``utils.get_tiled_runs``:
+
+* ``plan_name``, ``exit_status``: number of runs of each
+* ``day``, ``week`` (ISO 8601): number of runs started, in the ``timezone``
+  (an IANA name, default ``TIMEZONE``: ``TILED_TIMEZONE``, else the
+  server's zone, else UTC)
+* ``duration``: statistics (seconds) and histogram (``DURATION_BINS``)
+
+For a file tree, the counts (by ``mimetype``, ``directory``, ``day`` &
+``week`` of modification, and ``size``: lower boundary of ``SIZE_BINS``,
+in bytes) are kept up to date as files are seen by the mimetype detection
+hook (``custom.detect_mimetype``).  Files deleted since are still counted.
+
+Served (see ``server.py``), to clients that may read the catalog::
+
+    /api/v1/facets/{catalog}
+    /api/v1/facets/{catalog}?since=2022-11-01&until=2022-12-01
+    /api/v1/facets/{catalog}?key=plan_name:take_image&timezone=America/Chicago
+    /api/v1/facets/files
+"""
+
+from fastapi import APIRouter
+from fastapi import HTTPException
+from fastapi import Query
+from tiled.server.dependencies import SecureEntry
+from typing import List
+import bisect
+import catalogs
+import collections
+import datetime
+import os
+import pathlib
+import threading
+import time
+
+DURATION_BINS = [0, 1, 10, 60, 600, 3600, 86400]  # seconds
+EPOCH = datetime.datetime(1970, 1, 1)  # + milliseconds: date, in MongoDB
+SIZE_BINS = [0, 1_000, 1_000_000, 1_000_000_000]  # bytes
+
+rollups = {}  # file tree path: FileRollup
+_lock = threading.Lock()
+
+router = APIRouter()
+
+
+def server_timezone():
+    """IANA name of the server's time zone, such as ``"America/Chicago"``."""
+    try:  # such as /usr/share/zoneinfo/America/Chicago
+        return os.path.realpath("/etc/localtime").split("/zoneinfo/", 1)[1]
+    except IndexError:
+        return "UTC"
+
+
+def tzinfo(name):
+    """The time zone of this name, or the server's (Python < 3.9)."""
+    try:
+        from zoneinfo import ZoneInfo
+
+        return ZoneInfo(name)
+    except Exception:
+        return None
+
+
+TIMEZONE = os.environ.get("TILED_TIMEZONE") or server_timezone()
+
+
+def run_facets_pipeline(query, timezone):
+    """MongoDB aggregation pipeline (of ``run_start``) for all run facets."""
+
+    def date_string(fmt):
+        return {
+            "$dateToString": {
+                "format": fmt,
+                "date": {"$add": [EPOCH, {"$multiply": ["$time", 1000]}]},
+                "timezone": timezone,
+            }
+        }
+
+    def count_by(field, order=None):  # most frequent first, or in order
+        return [
+            {"$group": {"_id": field, "count": {"$sum": 1}}},
+            {"$sort": order or {"count": -1, "_id": 1}},
+        ]
+
+    has_duration = {"$match": {"duration": {"$ne": None}}}
+    return [
+        {"$match": query},  # first stage, as $text must be
+        {
+            "$lookup": {
+                "from": "run_stop",
+                "localField": "uid",
+                "foreignField": "run_start",
+                "as": "stop",
+            }
+        },
+        {"$unwind": {"path": "$stop", "preserveNullAndEmptyArrays": True}},
+        {
+            "$project": {
+                "_id": 0,
+                "plan_name": 1,
+                "time": 1,
+                "exit_status": {"$ifNull": ["$stop.exit_status", None]},
+                "duration": {"$subtract": ["$stop.time", "$time"]},
+            }
+        },
+        {
+            "$facet": {
+                "total": [{"$count": "count"}],
+                "plan_name": count_by("$plan_name"),
+                "exit_status": count_by("$exit_status"),
+                "day": count_by(date_string("%Y-%m-%d"), {"_id": 1}),
+                "week": count_by(date_string("%G-W%V"), {"_id": 1}),
+                "duration": [
+                    has_duration,
+                    {
+                        "$group": {
+                            "_id": None,
+                            "count": {"$sum": 1},
+                            "min": {"$min": "$duration"},
+                            "max": {"$max": "$duration"},
+                            "mean": {"$avg": "$duration"},
+                            "stdev": {"$stdDevPop": "$duration"},
+                            "total": {"$sum": "$duration"},
+                        }
+                    },
+                ],
+                "duration_histogram": [
+                    has_duration,
+                    {
+                        "$bucket": {
+                            "groupBy": "$duration",
+                            "boundaries": DURATION_BINS,
+                            "default": "longer",
+                        }
+                    },
+                ],
+            }
+        },
+    ]
+
+
+def run_facets(catalog, query, timezone=None):
+    """Facets of the runs of a databroker catalog that match the query."""
+    pipeline = run_facets_pipeline(query, timezone or TIMEZONE)
+    collection = catalogs.database(catalog)["run_start"]
+    (result,) = list(collection.aggregate(pipeline, allowDiskUse=True))
+
+    def counts(rows):
+        return {str(row["_id"]): row["count"] for row in rows}
+
+    duration = dict(result["duration"][0]) if result["duration"] else {}
+    duration.pop("_id", None)
+    return dict(
+        catalog=catalog,
+        total=result["total"][0]["count"] if result["total"] else 0,
+        plan_name=counts(result["plan_name"]),
+        exit_status=counts(result["exit_status"]),
+        day=counts(result["day"]),
+        week=counts(result["week"]),
+        duration=duration,
+        duration_histogram=counts(result["duration_histogram"]),
+    )
+
+
+def histogram_bin(value, bins):
+    """Lower boundary of the bin of this value; the last bin has no upper one."""
+    return str(bins[max(bisect.bisect_right(bins, value), 1) - 1])
+
+
+class FileRollup:
+    """Counts of the files of one file tree, updated one file at a time."""
+
+    def __init__(self, tree, directory):
+        self.tree = tree
+        self.directory = directory
+        self.files = {}  # filename: facet values, to replace a modified file
+        self.counts = collections.defaultdict(collections.Counter)
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def facet_values(self, filename, mimetype):
+        stat = filename.stat()
+        t = datetime.datetime.fromtimestamp(stat.st_mtime, tzinfo(TIMEZONE))
+        parts = filename.relative_to(self.directory).parts
+        iso_year, iso_week, _ = t.isocalendar()
+        return dict(
+            mimetype=mimetype,
+            directory=parts[0] if len(parts) > 1 else "",
+            day=t.strftime("%Y-%m-%d"),
+            week=f"{iso_year}-W{iso_week:02d}",
+            size=histogram_bin(stat.st_size, SIZE_BINS),
+            bytes=stat.st_size,
+        )
+
+    def add(self, filename, mimetype):
+        try:
+            values = self.facet_values(filename, mimetype)
+        except OSError:
+            return
+        with self._lock:
+            old = self.files.get(filename)
+            if old is not None:
+                self._count(old, -1)
+            self.files[filename] = values
+            self._count(values, 1)
+
+    def _count(self, values, n):
+        for facet, value in values.items():
+            if facet == "bytes":
+                self.bytes += n * value
+            else:
+                self.counts[facet][value] += n
+
+    def facets(self):
+        with self._lock:
+            counts = {facet: +counter for facet, counter in self.counts.items()}
+            total, total_bytes = len(self.files), self.bytes
+        result = dict(catalog=self.tree, total=total, bytes=total_bytes)
+        for facet in "mimetype directory".split():
+            result[facet] = dict(counts.get(facet, {}).most_common())
+        for facet in "day week size".split():
+            result[facet] = dict(sorted(counts.get(facet, {}).items()))
+        return result
+
+
+def add_file(filename, mimetype):
+    """Called by the mimetype detection hook, for each file it has seen."""
+    found = catalogs.tree_of(filename)
+    if found is None:
+        return
+    tree, directory = found
+    with _lock:
+        rollup = rollups.get(tree)
+        if rollup is None:
+            rollup = rollups[tree] = FileRollup(tree, directory)
+    rollup.add(pathlib.Path(filename).resolve(), mimetype)
+
+
+# {path}: the catalog, checked by SecureEntry as for tiled's own routes
+@router.get("/facets/{path:path}")
+def facets(
+    path: str,
+    since: str = Query(None, description="ISO8601"),
+    until: str = Query(None, description="ISO8601"),
+    text: List[str] = Query([]),
+    text_case: List[str] = Query([]),
+    key: List[str] = Query([], description="name:value"),
+    timezone: str = Query(None, description=f"such as America/Chicago, default {TIMEZONE}"),
+    entry=SecureEntry(scopes=["read:metadata"]),
+):
+    from federated import parse_keys
+
+    t0 = time.perf_counter()
+    catalog = path.strip("/")
+    if catalog in catalogs.mongo_catalogs():
+        try:
+            query = catalogs.run_start_filter(
+                since=since,
+                until=until,
+                text=text,
+                text_case=text_case,
+                **parse_keys(key),
+            )
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=str(exc))
+        from pymongo.errors import OperationFailure
+
+        try:
+            result = run_facets(catalog, query, timezone)
+        except OperationFailure as exc:  # such as an unknown time zone
+            raise HTTPException(status_code=400, detail=str(exc))
+    elif catalog in catalogs.file_trees():
+        if any((since, until, text, text_case, key)):
+            raise HTTPException(
+                status_code=400, detail="Search terms apply to databroker catalogs."
+            )
+        rollup = rollups.get(catalog)
+        result = dict(catalog=catalog, total=0) if rollup is None else rollup.facets()
+    else:
+        raise HTTPException(status_code=404, detail=f"No catalog {catalog!r}")
+    result["seconds"] = time.perf_counter() - t0
+    return result
@@ -0,0 +1,180 @@
+"""
+Search all the databroker catalogs at once.
+
+One query is sent to every databroker catalog of ``config.yml`` at the same
+time.  The results are merged, most recent first, with a global ``limit``.
+The ``cursor`` of the response gives the next page.  A catalog that does
+not answer within ``timeout`` seconds is listed in ``timed_out`` and the
+results of the other catalogs are returned.  Each catalog is searched by
+its own threads (``PER_CATALOG``): one that does not answer cannot hold up
+the others; while all its threads are busy, it is listed in ``timed_out``
+at once.  Only the catalogs the client may read are searched.
+
+The search terms are those of ``utils.get_tiled_runs``.  Metadata keys
+(of the start document) are given as ``key=name:value``.  Served (see
+``server.py``)::
+
+    /api/v1/federated/search?text=sample_A&limit=20
+    /api/v1/federated/search?since=2022-11-01&key=plan_name:take_image
+    /api/v1/federated/search?...&cursor=<cursor from previous response>
+"""
+
+from fastapi import APIRouter
+from fastapi import HTTPException
+from fastapi import Query
+from typing import List
+import base64
+import catalogs
+import concurrent.futures
+import json
+import threading
+import time
+
+PER_CATALOG = 4  # searches of one catalog at the same time
+TIMEOUT = 5  # seconds
+PROJECTION = {
+    "_id": 0, "uid": 1, "scan_id": 1, "plan_name": 1, "num_points": 1, "time": 1
+}
+
+router = APIRouter()
+_executors = {}  # catalog: (executor, semaphore of its free threads)
+_lock = threading.Lock()
+
+
+def encode_cursor(run):
+    content = json.dumps(dict(time=run["time"], uid=run["uid"])).encode()
+    return base64.urlsafe_b64encode(content).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        content = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return content["time"], content["uid"]
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+
+def after_cursor(query, cursor):
+    """Add to the query: only runs after the cursor (in the order of search)."""
+    if cursor is None:
+        return query
+    t, uid = decode_cursor(cursor)
+    query = dict(query)
+    query["$or"] = [{"time": {"$lt": t}}, {"time": t, "uid": {"$lt": uid}}]
+    return query
+
+
+def search_catalog(catalog, query, limit, timeout):
+    """Most recent runs of one catalog, with their stop documents."""
+    import pymongo
+
+    db = catalogs.database(catalog)
+    with pymongo.timeout(timeout):  # all of it, server selection too
+        starts = list(
+            db["run_start"]
+            .find(query, PROJECTION)
+            .sort([("time", -1), ("uid", -1)])
+            .limit(limit)
+        )
+        stops = {
+            doc["run_start"]: doc
+            for doc in db["run_stop"].find(
+                {"run_start": {"$in": [doc["uid"] for doc in starts]}},
+                {"_id": 0, "run_start": 1, "exit_status": 1, "time": 1},
+            )
+        }
+    return [
+        dict(catalog=catalog, **catalogs.run_summary(doc, stops.get(doc["uid"])))
+        for doc in starts
+    ]
+
+
+def submit(catalog, *args):
+    """Search the catalog in one of its threads, or ``None`` if all are busy."""
+    with _lock:
+        if catalog not in _executors:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                PER_CATALOG, thread_name_prefix=f"federated-{catalog}"
+            )
+            _executors[catalog] = (executor, threading.BoundedSemaphore(PER_CATALOG))
+        executor, free = _executors[catalog]
+    if not free.acquire(blocking=False):
+        return None
+    future = executor.submit(search_catalog, catalog, *args)
+    future.add_done_callback(lambda _future: free.release())
+    return future
+
+
+def federated_search(query, limit=20, cursor=None, timeout=TIMEOUT, names=None):
+    """Search the catalogs (all, or ``names``) concurrently, merge, return one page."""
+    query = after_cursor(query, cursor)
+    names = list(catalogs.mongo_catalogs() if names is None else names)
+    futures, timed_out = {}, []
+    for catalog in names:
+        future = submit(catalog, query, limit, timeout)
+        if future is None:
+            timed_out.append(catalog)  # still busy with earlier searches
+        else:
+            futures[future] = catalog
+    done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+    timed_out += [futures[f] for f in not_done]
+    runs, errors, more = [], {}, False
+    for future in done:
+        try:
+            found = future.result()
+        except Exception as exc:
+            errors[futures[future]] = str(exc)
+            continue
+        runs += found
+        more = more or len(found) == limit
+    runs.sort(key=lambda run: (run["time"] or 0, run["uid"]), reverse=True)
+    more = more or len(runs) > limit
+    runs = runs[:limit]
+    return dict(
+        runs=runs,
+        cursor=encode_cursor(runs[-1]) if more and len(runs) > 0 else None,
+        catalogs=sorted(names),
+        timed_out=sorted(timed_out),
+        errors=errors,
+    )
+
+
+def parse_keys(items):
+    """``["plan_name:take_image", "scan_id:12"]`` to a dictionary."""
+    keys = {}
+    for item in items:
+        name, sep, value = item.partition(":")
+        if sep == "":
+            raise ValueError(f"Expected key=name:value, received {item!r}")
+        try:
+            keys[name] = json.loads(value)  # numbers, true, false, null
+        except ValueError:
+            keys[name] = value
+    return keys
+
+
+@router.get("/federated/search")
+def search(
+    since: str = Query(None, description="ISO8601"),
+    until: str = Query(None, description="ISO8601"),
+    text: List[str] = Query([]),
+    text_case: List[str] = Query([]),
+    key: List[str] = Query([], description="name:value"),
+    limit: int = Query(20, ge=1, le=1000),
+    cursor: str = Query(None),
+    timeout: float = Query(TIMEOUT, gt=0, le=60),
+    readable=catalogs.access_check(),
+):
+    t0 = time.perf_counter()
+    names = [catalog for catalog in catalogs.mongo_catalogs() if readable(catalog)]
+    try:
+        query = catalogs.run_start_filter(
+            since=since, until=until, text=text, text_case=text_case, **parse_keys(key)
+        )
+        result = federated_search(
+            query, limit=limit, cursor=cursor, timeout=timeout, names=names
+        )
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    result["seconds"] = time.perf_counter() - t0
+    return result
@@ -0,0 +1,280 @@
+"""
+Pooled, read-ahead handlers of area detector HDF5 files (bluesky runs).
+
+The frames of an area detector are in external HDF5 files, referenced by
+``resource`` & ``datum_page`` documents.  The handlers of
+``area-detector-handlers`` are created for each run object (so again for
+each request) and open their file each time.  Then each frame (datum) is
+read by itself.
+
+These handlers (for the ``AD_HDF5`` & ``AD_HDF5_SWMR`` specs) share one
+pool of open files, kept across requests.  The pool is bounded
+(``MAX_OPEN`` files, least recently used closed first).  Sequential reads
+of a dataset (as when all the datums of a ``datum_page`` are filled, one
+after the other) are detected: each read then also brings in the
+following frames, in one HDF5 read, with a window that doubles up to
+``READ_AHEAD`` bytes.  The buffers of all files together are bounded
+(``MAX_BUFFERED`` bytes, those of the least recently used files dropped
+first).  The frames returned are copies, which do not keep a buffer in
+memory.
+
+Replace the handlers in the ``args`` of each databroker catalog of
+``config.yml``::
+
+    handler_registry:
+      AD_HDF5: handlers:AreaDetectorHDF5Handler
+      AD_HDF5_SWMR: handlers:AreaDetectorHDF5SWMRHandler
+
+Served (see ``server.py``), to clients that may read all the databroker
+catalogs (the files of the pool are not told apart by catalog)::
+
+    /api/v1/handlers/pool
+
+Compare the read times of all frames of an area detector file::
+
+    python handlers.py /path/to/file.h5
+"""
+
+from area_detector_handlers import HandlerBase
+from fastapi import APIRouter
+from fastapi import HTTPException
+import catalogs
+import collections
+import metrics
+import numpy
+import os
+import threading
+
+AD_KEY = "/entry/data/data"  # HDF5 address of the frames
+MAX_OPEN = int(os.environ.get("TILED_HANDLER_MAX_OPEN", 64))  # files
+MAX_BUFFERED = int(os.environ.get("TILED_HANDLER_MAX_BUFFERED", 256 * 2**20))  # bytes
+READ_AHEAD = int(os.environ.get("TILED_HANDLER_READ_AHEAD", 64 * 2**20))  # bytes
+
+router = APIRouter()
+
+
+class FrameReader:
+    """One open HDF5 dataset, with a read-ahead buffer of frames."""
+
+    def __init__(self, filename, key, swmr=False, read_ahead=READ_AHEAD):
+        self.filename = filename
+        self.key = key
+        self.swmr = swmr
+        self.read_ahead = read_ahead  # bytes, at most
+        self.file = None
+        self.dataset = None
+        self.buffer = None  # (start, stop, frames)
+        self.next = None  # first frame after the last read
+        self.window = 1  # frames per read, doubles while reads are sequential
+        self.lock = threading.Lock()
+
+    def open(self):
+        import h5py
+
+        self.file = h5py.File(self.filename, "r", swmr=self.swmr)
+        try:
+            self.dataset = self.file[self.key]
+        except KeyError as error:
+            self.file.close()
+            self.file = None
+            # as area_detector_handlers: so that the Filler will retry
+            raise IOError(f"No dataset {self.key!r} in {self.filename}") from error
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            self.file = self.dataset = self.buffer = None
+
+    def drop_buffer(self):
+        with self.lock:
+            self.buffer = None
+
+    def buffered_bytes(self):
+        buffer = self.buffer
+        return 0 if buffer is None else buffer[2].nbytes
+
+    def read(self, start, stop):
+        """Frames ``[start:stop]`` (a copy)."""
+        with self.lock:
+            if self.file is None:  # new, or closed by the pool meanwhile
+                self.open()
+            elif self.swmr:
+                self.dataset.id.refresh()  # the file may still be written
+
+            sequential = start == self.next
+            self.next = stop
+            if self.buffer is not None:
+                b_start, b_stop, frames = self.buffer
+                if b_start <= start and stop <= b_stop:
+                    metrics.count("handler_frames", source="buffer")
+                    return frames[start - b_start : stop - b_start].copy()
+
+            shape = self.dataset.shape
+            frame_bytes = self.dataset.dtype.itemsize * int(numpy.prod(shape[1:]))
+            if sequential:
+                limit = max(1, self.read_ahead // max(1, frame_bytes * (stop - start)))
+                self.window = min(2 * self.window, limit)
+            else:
+                self.window = 1
+            end = min(start + self.window * (stop - start), len(self.dataset))
+            frames = self.dataset[start : max(stop, end)]
+            self.buffer = (start, start + len(frames), frames)
+            metrics.count("handler_frames", source="file")
+            return frames[: stop - start].copy()
+
+
+class FramePool:
+    """
+    Open FrameReaders, least recently used closed beyond ``size``.
+
+    Their buffers together are kept within ``max_buffered`` bytes.
+    """
+
+    def __init__(self, size=MAX_OPEN, max_buffered=MAX_BUFFERED):
+        self.size = size
+        self.max_buffered = max_buffered
+        self.readers = collections.OrderedDict()  # (filename, key, swmr): reader
+        self._lock = threading.Lock()
+
+    def reader(self, filename, key, swmr=False):
+        ident = (filename, key, swmr)
+        closing = []
+        with self._lock:
+            reader = self.readers.get(ident)
+            if reader is None:
+                metrics.count("handler_pool", result="miss")
+                read_ahead = min(READ_AHEAD, self.max_buffered)
+                reader = FrameReader(filename, key, swmr, read_ahead)
+                self.readers[ident] = reader
+                while len(self.readers) > self.size:
+                    closing.append(self.readers.popitem(last=False)[1])
+            else:
+                metrics.count("handler_pool", result="hit")
+                self.readers.move_to_end(ident)
+        for old in closing:
+            old.close()
+        return reader
+
+    def read(self, filename, key, start, stop, swmr=False):
+        reader = self.reader(filename, key, swmr)
+        frames = reader.read(start, stop)
+        self.limit_buffers(keep=reader)
+        return frames
+
+    def limit_buffers(self, keep=None):
+        """Drop buffers, least recently used first, beyond ``max_buffered``."""
+        with self._lock:
+            readers = list(self.readers.values())  # least recently used first
+        total = sum(r.buffered_bytes() for r in readers)
+        for reader in readers:
+            if total <= self.max_buffered:
+                break
+            if reader is not keep and reader.buffer is not None:
+                total -= reader.buffered_bytes()
+                reader.drop_buffer()
+                metrics.count("handler_buffers_dropped")
+
+    def clear(self):
+        with self._lock:
+            readers = list(self.readers.values())
+            self.readers = collections.OrderedDict()
+        for reader in readers:
+            reader.close()
+
+    def summary(self):
+        with self._lock:
+            readers = list(self.readers.values())
+        return dict(
+            max_open=self.size,
+            read_ahead_bytes=min(READ_AHEAD, self.max_buffered),
+            max_buffered_bytes=self.max_buffered,
+            buffered_bytes=sum(r.buffered_bytes() for r in readers),
+            files=[
+                dict(
+                    filename=r.filename,
+                    key=r.key,
+                    swmr=r.swmr,
+                    open=r.file is not None,
+                    window=r.window,
+                    buffered=None if r.buffer is None else r.buffer[:2],
+                    buffered_bytes=r.buffered_bytes(),
+                )
+                for r in reversed(readers)  # most recently used first
+            ],
+        )
+
+
+pool = FramePool()
+
+
+class AreaDetectorHDF5Handler(HandlerBase):
+    """
+    Handler for the 'AD_HDF5' spec, frames read through the shared pool.
+
+    Returns numpy arrays (not dask) of shape ``(frame_per_point, ...)``.
+    """
+
+    specs = {"AD_HDF5"} | HandlerBase.specs
+    swmr = False
+
+    def __init__(self, filename, frame_per_point=1):
+        self._filename = filename
+        self._fpp = frame_per_point
+
+    def __call__(self, point_number):
+        start = point_number * self._fpp
+        stop = start + self._fpp
+        frames = pool.read(self._filename, AD_KEY, start, stop, swmr=self.swmr)
+        if len(frames) == 0:
+            raise ValueError(
+                "Invalid slicing bounds. Handler is slicing beyond size of dataset"
+            )
+        return frames
+
+    def get_file_list(self, datum_kwarg_gen):
+        return [self._filename]
+
+    def close(self):
+        pass  # the file stays open in the pool
+
+
+class AreaDetectorHDF5SWMRHandler(AreaDetectorHDF5Handler):
+    """Handler for the 'AD_HDF5_SWMR' spec (files that may still be written)."""
+
+    specs = {"AD_HDF5_SWMR"} | HandlerBase.specs
+    swmr = True
+
+
+@router.get("/handlers/pool")
+def pool_summary(readable=catalogs.access_check()):
+    if not all(readable(catalog) for catalog in catalogs.mongo_catalogs()):
+        raise HTTPException(status_code=403, detail="Needs all the catalogs")
+    return pool.summary()
+
+
+def main():
+    from area_detector_handlers.handlers import AreaDetectorHDF5Handler as Original
+    import h5py
+    import sys
+    import time
+
+    filename = sys.argv[1]
+    with h5py.File(filename, "r") as f:
+        n = len(f[AD_KEY])
+        t0 = time.perf_counter()
+        f[AD_KEY][()]
+        print(f"{n} frames, one read: {time.perf_counter() - t0:.3f} s")
+
+    for handler_class in (Original, AreaDetectorHDF5Handler):
+        handler = handler_class(filename)
+        t0 = time.perf_counter()
+        for point_number in range(n):
+            numpy.asarray(handler(point_number))
+        handler.close()
+        label = f"{handler_class.__module__}.{handler_class.__name__}"
+        print(f"{label}, by frame: {time.perf_counter() - t0:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -163,6 +163,53 @@ def get_run_data(server, catalog, uid, stream, data_name, data_format="json"):
     return r
 
 
+def find_runs_everywhere(server, text=[], since=None, until=None, limit=20, port=8000):
+    # Search all catalogs at once (see federated.py), most recent first.
+    params = dict(text=text, since=since, until=until, limit=limit)
+    uri = f"http://{server}:{port}/api/v1/federated/search"
+    r = requests.get(uri, params={k: v for k, v in params.items() if v is not None})
+    r = r.json()
+
+    table = pyRestTable.Table()
+    table.labels = "catalog scan_id plan_name start duration(s) exit uid7".split()
+    for run in r["runs"]:
+        table.addRow(
+            (
+                run["catalog"],
+                run["scan_id"],
+                run["plan_name"],
+                run["datetime"],
+                run["duration"],
+                run["exit_status"],
+                run["uid"][:7],
+            )
+        )
+    print(table)
+    if len(r["timed_out"]) > 0:
+        print(f"partial results, timed out: {r['timed_out']}")
+
+    return r
+
+
+def catalog_facets(server, catalog, since=None, until=None, port=8000):
+    # Counts of runs by plan_name, exit_status, week (see facets.py).
+    params = dict(since=since, until=until)
+    uri = f"http://{server}:{port}/api/v1/facets/{catalog}"
+    r = requests.get(uri, params={k: v for k, v in params.items() if v is not None})
+    r = r.json()
+
+    print(f"{catalog=} has {r['total']} runs")
+    for facet in "plan_name exit_status week".split():
+        table = pyRestTable.Table()
+        table.labels = [facet, "runs"]
+        for value, count in r[facet].items():
+            table.addRow((value, count))
+        print(table)
+    print(f"duration (s): {r['duration']}")
+
+    return r
+
+
 def main():
     server = "localhost"
 
@@ -178,6 +225,12 @@ def main():
         r = find_by_plan_name(server, "20idb_usaxs", "tune_a2rp")
         r = find_by_plan_name(server, "bdp2022", "take_image")
 
+    if False:
+        r = find_runs_everywhere(server, text=["bdp"])
+
+    if False:
+        r = catalog_facets(server, "bdp2022", since="2022-11-01")
+
     if False:
         r = get_run_metadata(
             server, "bdp2022", "00714a91-c33e-4e7b-90fd-2e8f385bebc9",
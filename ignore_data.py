@@ -1,8 +1,10 @@
 from tiled.adapters.array import ArrayAdapter
 from tiled.adapters.mapping import MapAdapter
+import metrics
 import numpy
 
 
+@metrics.timed("read", "ignore")
 def read_ignore(filename):
     arrays = dict(
         ignore=ArrayAdapter.from_array(
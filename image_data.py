@@ -6,8 +6,11 @@ from PIL import Image
 from PIL.TiffImagePlugin import IFDRational
 from tiled.adapters.array import ArrayAdapter
 from tiled.adapters.mapping import MapAdapter
+import metadata_budget
+import metrics
 import numpy
 import pathlib
+import unrecognized
 import yaml
 
 ROOT = pathlib.Path(__file__).parent
@@ -27,6 +30,7 @@ MIMETYPES = """
 # TODO:     image/svg+xml  not handled by PIL
 
 EMPTY_ARRAY = numpy.array([0,0])
+MIMETYPE = "image/*"  # for metrics: any of MIMETYPES
 
 
 def interpret_IFDRational(data):
@@ -38,6 +42,7 @@ def interpret_IFDRational(data):
     return md
 
 
+@metrics.timed("metadata", MIMETYPE)
 def interpret_exif(image):
     from PIL.ExifTags import TAGS
 
@@ -56,6 +61,7 @@ def interpret_exif(image):
     return md
 
 
+@metrics.timed("metadata", MIMETYPE)
 def image_metadata(image):
     attrs = """
         bits
@@ -110,6 +116,7 @@ def image_metadata(image):
     return md
 
 
+@metrics.timed("read", MIMETYPE)
 def read_image(filename):
     fn = pathlib.Path(filename).name
     try:
@@ -128,9 +135,13 @@ def read_image(filename):
         pixels = numpy.array(pixels).reshape(shape)
         if len(shape) > 2:
             pixels = numpy.moveaxis(pixels, -1, 0)  # put the colors first
-        return ArrayAdapter.from_array(pixels, metadata=md)
+        return metadata_budget.array_adapter(pixels, md)
 
     except Exception as exc:
+        # next time, excluded (see exclude.yml) without reading it again
+        unrecognized.record(
+            filename, f"unreadable: {exc!r}", "application/octet-stream"
+        )
         arrays = dict(
             ignore=ArrayAdapter.from_array(
                 numpy.array([0,0]), metadata=dict(ignore="placeholder, ignore")
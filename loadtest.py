@@ -0,0 +1,529 @@
+"""
+End-to-end load test of the server, with local stand-ins for production.
+
+The server is started (as ``start-tiled.sh`` does) from a generated
+``config.yml`` with:
+
+* a databroker catalog (``loadtest``) of synthetic bluesky runs (plans
+  ``scan``, ``count`` & ``take_image``, the last with area detector frames
+  in HDF5 files, read by ``handlers.py``), in MongoDB: a running server
+  (``--mongo-uri``), else a local ``mongod`` (if installed), else
+  ``mongomock`` in the server process;
+* a file tree of the synthetic corpus of ``benchmark.py`` (SPEC, MDA,
+  images, HDF5/NeXus).
+
+Concurrent clients replay the requests of the client code of this repo:
+
+=================  ============================================================
+scenario           requests as
+=================  ============================================================
+``overview``       ``http_client.overview``: the 20 most recent runs
+``get_tiled_runs`` ``utils.get_tiled_runs`` (week, plan_name) and
+                   ``run_summary_table``: search with metadata
+``run_metadata``   ``http_client.get_run_metadata``: a run, or its stream
+``get_run_data``   ``http_client.get_run_data``: a column of a run, as JSON
+``block``          a block of area detector frames (``pyapi_client``)
+``frames``         10 consecutive area detector frames (a slice)
+``facets``         ``/facets`` of the catalog (``http_client.catalog_facets``)
+``uid_prefix``     ``/runs/{catalog}/uid/{uid7}``
+``file_metadata``  metadata of the corpus files (the readers parse them)
+``file_array``     image arrays of the corpus files
+=================  ============================================================
+
+``facets`` & ``uid_prefix`` need MongoDB (not mongomock).  Each scenario
+of the ``--mix`` is run by itself, then all of them together (weighted).
+Reported for each: p50/p95/p99 latency, throughput, errors, and the
+server's resident memory (all workers) after it.  Save the results and
+compare them with those of a previous version, to catch regressions
+before deployment::
+
+    python loadtest.py --output before.json
+    python loadtest.py --mix dashboard --concurrency 32 --workers 4
+    python loadtest.py --compare before.json after.json
+"""
+
+import benchmark
+import collections
+import json
+import pathlib
+import random
+import scaling
+import time
+import uuid
+
+CATALOG = "loadtest"
+COLLECTIONS = dict(
+    start="run_start",
+    stop="run_stop",
+    descriptor="event_descriptor",
+    event="event",
+    resource="resource",
+    datum="datum",
+)
+DATABASE = "loadtest-bluesky"  # dropped and seeded again, with --mongo-uri
+DAYS = 60  # the runs started over this many days
+FRAME_SHAPE = (1, 256, 256)  # frame_per_point, rows, columns
+HANDLERS = {"AD_HDF5": "handlers:AreaDetectorHDF5Handler"}
+MONGO_ONLY = ["facets", "uid_prefix"]  # custom routes of MongoDB catalogs
+PLANS = dict(scan=5, count=3, take_image=2)  # weights
+SAMPLES = "silicon lanthanum_hexaboride glassy_carbon water empty".split()
+MIXES = dict(
+    dashboard=dict(overview=3, get_tiled_runs=3, run_metadata=2, facets=1),
+    analysis=dict(
+        get_tiled_runs=1, run_metadata=2, get_run_data=3, block=2, frames=2
+    ),
+    files=dict(file_metadata=1, file_array=1),
+    mixed=dict(
+        overview=2,
+        get_tiled_runs=2,
+        run_metadata=2,
+        get_run_data=2,
+        block=1,
+        frames=1,
+        facets=1,
+        uid_prefix=1,
+        file_metadata=2,
+        file_array=1,
+    ),
+)
+
+
+def synthetic_runs(n_runs, image_directory, now, seed=0):
+    """
+    Documents (list of ``(name, doc)``) of each synthetic run, in order.
+
+    The same arguments always give the same runs.  The frames of the
+    ``take_image`` runs are written in ``image_directory`` (once).
+    """
+    import event_model
+
+    rng = random.Random(seed)
+    image_directory = pathlib.Path(image_directory)
+    image_directory.mkdir(parents=True, exist_ok=True)
+
+    def new_uid():
+        return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+    t = now - DAYS * 86400
+    for scan_id in range(1, n_runs + 1):
+        t += rng.uniform(0, 2 * DAYS * 86400 / n_runs)
+        plan_name = rng.choices(list(PLANS), weights=list(PLANS.values()))[0]
+        num_points = 1 if plan_name == "count" else rng.choice([11, 21, 51, 101])
+        bundle = event_model.compose_run(
+            uid=new_uid(),
+            time=t,
+            metadata=dict(
+                plan_name=plan_name,
+                scan_id=scan_id,
+                num_points=num_points,
+                sample=rng.choice(SAMPLES),
+                title=f"synthetic {plan_name} #{scan_id}",
+                detectors=["det"],
+                motors=["motor"],
+            ),
+        )
+        docs = [("start", bundle.start_doc)]
+        data_keys = {
+            name: dict(source=f"SIM:{name}", dtype="number", shape=[])
+            for name in "motor I0 det".split()
+        }
+        if plan_name == "take_image":
+            filename = f"{bundle.start_doc['uid']}.h5"
+            write_frames(image_directory / filename, num_points, seed + scan_id)
+            resource = bundle.compose_resource(
+                spec="AD_HDF5",
+                root=str(image_directory),
+                resource_path=filename,
+                resource_kwargs=dict(frame_per_point=FRAME_SHAPE[0]),
+                uid=new_uid(),
+            )
+            docs.append(("resource", resource.resource_doc))
+            data_keys["adsimdet_image"] = dict(
+                source="SIM:image",
+                dtype="array",
+                shape=list(FRAME_SHAPE),
+                external="FILESTORE:",
+            )
+        descriptor = bundle.compose_descriptor(
+            name="primary", data_keys=data_keys, uid=new_uid(), time=t
+        )
+        docs.append(("descriptor", descriptor.descriptor_doc))
+        for i in range(num_points):
+            data = dict(
+                motor=0.1 * i, I0=rng.gauss(1e5, 300), det=rng.gauss(1000, 30)
+            )
+            if plan_name == "take_image":
+                datum = resource.compose_datum(datum_kwargs=dict(point_number=i))
+                docs.append(("datum", datum))
+                data["adsimdet_image"] = datum["datum_id"]
+            event = descriptor.compose_event(
+                data=data,
+                timestamps={k: t + i for k in data},
+                seq_num=i + 1,
+                uid=new_uid(),
+                time=t + i,
+            )
+            docs.append(("event", event))
+        stop = bundle.compose_stop(
+            exit_status=rng.choices(["success", "abort", "fail"], [90, 8, 2])[0],
+            time=t + num_points + rng.uniform(1, 5),
+            uid=new_uid(),
+        )
+        docs.append(("stop", stop))
+        yield docs
+
+
+def write_frames(path, n_frames, seed):
+    """HDF5 file of area detector frames (as AD_HDF5), unless it exists."""
+    import h5py
+    import numpy
+
+    if path.exists():
+        return
+    rng = numpy.random.default_rng(seed)
+    shape = (n_frames * FRAME_SHAPE[0], *FRAME_SHAPE[1:])
+    temporary = path.with_name(f".{path.name}")
+    with h5py.File(temporary, "w") as f:
+        f.create_dataset(
+            "/entry/data/data",
+            data=rng.integers(0, 4096, shape, dtype="uint16"),
+            chunks=(1, *FRAME_SHAPE[1:]),
+        )
+    temporary.replace(path)
+
+
+def seed_database(database, runs, text_index=True):
+    """Insert the documents of the runs, with databroker's indexes."""
+    for docs in runs:
+        by_collection = collections.defaultdict(list)
+        for name, doc in docs:
+            by_collection[COLLECTIONS[name]].append(dict(doc))
+        for name, documents in by_collection.items():
+            database[name].insert_many(documents)
+    database["run_start"].create_index("uid", unique=True)
+    database["run_start"].create_index([("time", -1), ("uid", -1)])
+    database["run_start"].create_index("scan_id")
+    database["run_stop"].create_index("run_start", unique=True)
+    database["event_descriptor"].create_index("run_start")
+    database["event_descriptor"].create_index("uid", unique=True)
+    database["event"].create_index([("descriptor", 1), ("seq_num", 1)])
+    database["resource"].create_index("uid", unique=True)
+    database["datum"].create_index("datum_id", unique=True)
+    database["datum"].create_index("resource")
+    if text_index:  # for tiled's FullText queries (not in mongomock)
+        database["run_start"].create_index([("$**", "text")])
+
+
+def mongomock_tree(runs, image_directory, now, seed=0, handler_registry=None):
+    """Databroker catalog of the synthetic runs, in mongomock (in the server)."""
+    from databroker.mongo_normalized import Tree
+
+    tree = Tree.from_mongomock(handler_registry=handler_registry)
+    runs = synthetic_runs(runs, image_directory, now, seed)
+    seed_database(tree.database, runs, text_index=False)
+    return tree
+
+
+def start_mongod(directory, port=27117):
+    """Local mongod (if installed) on an empty database; ``(process, uri)``."""
+    import pymongo
+    import shutil
+    import subprocess
+
+    mongod = shutil.which("mongod")
+    if mongod is None:
+        return None, None
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    process = subprocess.Popen(
+        [mongod, "--dbpath", str(directory), "--port", str(port)]
+        + ["--bind_ip", "127.0.0.1", "--quiet"],
+        stdout=subprocess.DEVNULL,
+    )
+    uri = f"mongodb://127.0.0.1:{port}"
+    client = pymongo.MongoClient(uri, serverSelectionTimeoutMS=30_000)
+    client.admin.command("ping")  # waits until it answers
+    return process, uri
+
+
+def catalog_tree(args, tempdir, now):
+    """Tree of the synthetic catalog for config.yml; and a mongod, if started."""
+    import catalogs
+
+    image_directory = tempdir / "frames"
+    mongod, uri = None, args.mongo_uri
+    if uri is None and not args.mongomock:
+        mongod, uri = start_mongod(tempdir / "mongod")
+    if uri is None:
+        print("MongoDB: mongomock, in the server")
+        tree = dict(
+            path=CATALOG,
+            tree="loadtest:mongomock_tree",
+            args=dict(
+                runs=args.runs,
+                image_directory=str(image_directory),
+                now=now,
+                seed=args.seed,
+                handler_registry=HANDLERS,
+            ),
+        )
+        return tree, mongod
+
+    import pymongo
+
+    print(f"MongoDB: {uri}/{DATABASE}")
+    client = pymongo.MongoClient(uri)
+    client.drop_database(DATABASE)
+    runs = synthetic_runs(args.runs, image_directory, now, args.seed)
+    seed_database(client[DATABASE], runs)
+    tree = dict(
+        path=CATALOG,
+        tree=catalogs.MONGO_TREE,
+        args=dict(uri=f"{uri}/{DATABASE}", handler_registry=HANDLERS),
+    )
+    return tree, mongod
+
+
+def run_summaries(n_runs, image_directory, now, seed=0):
+    """What the clients know of the runs: uid, time, plan_name, num_points."""
+    return [
+        dict(
+            uid=docs[0][1]["uid"],
+            time=docs[0][1]["time"],
+            plan_name=docs[0][1]["plan_name"],
+            num_points=docs[0][1]["num_points"],
+        )
+        for docs in synthetic_runs(n_runs, image_directory, now, seed)
+    ]
+
+
+def search_params(since, until, **keys):
+    """
+    Query parameters of a search, as sent by the tiled client.
+
+    The queries of ``utils.get_tiled_runs``: ``Key("time") >= since``,
+    ``Key("time") < until`` (timestamps), and ``Key(k) == v`` for the keys.
+    """
+    params = collections.defaultdict(list)
+
+    def add(query, **condition):
+        for field, value in condition.items():
+            params[f"filter[{query}][condition][{field}]"].append(value)
+
+    add("comparison", operator="ge", key="time", value=json.dumps(since))
+    add("comparison", operator="lt", key="time", value=json.dumps(until))
+    for k, v in keys.items():
+        add("eq", key=k, value=json.dumps(v))
+    return dict(params)
+
+
+def scenario_requests(scenario, runs, corpus, rng, n=500):
+    """``n`` routes (label, route) of this scenario."""
+    import datetime
+    import urllib.parse
+
+    def isotime(t):
+        return datetime.datetime.fromtimestamp(t).isoformat(sep=" ")
+
+    def route(path, **params):
+        query = urllib.parse.urlencode(params, doseq=True)
+        return f"/api/v1/{path}" + (f"?{query}" if query else "")
+
+    images = [run for run in runs if run["plan_name"] == "take_image"]
+    files = collections.defaultdict(list)  # "metadata" or "array": routes
+    for label, r in scaling.file_requests(corpus):
+        files[label.split()[0]].append(r)
+    routes = []
+    for _ in range(n):
+        run = rng.choice(runs)
+        image = rng.choice(images) if images else None
+        if scenario == "overview":
+            r = route(
+                f"node/search/{CATALOG}",
+                **{"page[offset]": max(0, len(runs) - 20), "page[limit]": 20},
+            )
+        elif scenario == "get_tiled_runs":
+            since = rng.uniform(runs[0]["time"], runs[-1]["time"])
+            keys = {}
+            if rng.random() < 0.5:
+                keys["plan_name"] = rng.choice(list(PLANS))
+            params = search_params(since, since + 7 * 86400, **keys)
+            r = route(f"node/search/{CATALOG}", **params)
+        elif scenario == "run_metadata":
+            stream = rng.choice(["", "/primary"])
+            r = route(f"node/metadata/{CATALOG}/{run['uid']}{stream}")
+        elif scenario == "get_run_data":
+            name = rng.choice(["motor", "I0", "det"])
+            r = route(
+                f"array/full/{CATALOG}/{run['uid']}/primary/data/{name}", format="json"
+            )
+        elif scenario in ("block", "frames") and image is None:
+            continue
+        elif scenario == "block":
+            r = route(
+                f"array/block/{CATALOG}/{image['uid']}/primary/data/adsimdet_image",
+                block="0,0,0,0",
+                format="application/octet-stream",
+            )
+        elif scenario == "frames":
+            first = rng.randrange(max(1, image["num_points"] - 10))
+            r = route(
+                f"array/full/{CATALOG}/{image['uid']}/primary/data/adsimdet_image",
+                slice=f"{first}:{first + 10}",
+                format="application/octet-stream",
+            )
+        elif scenario == "facets":
+            since = rng.uniform(runs[0]["time"], runs[-1]["time"])
+            r = route(f"facets/{CATALOG}", since=isotime(since))
+        elif scenario == "uid_prefix":
+            r = route(f"runs/{CATALOG}/uid/{run['uid'][:7]}")
+        elif scenario == "file_metadata":
+            r = rng.choice(files["metadata"])
+        elif scenario == "file_array":
+            r = rng.choice(files["array"])
+        else:
+            raise KeyError(f"Unknown scenario {scenario!r}")
+        routes.append((scenario, r))
+    return routes
+
+
+def statistics(results, elapsed, rss):
+    latencies = [r[1] for r in results if r[2] == 200]
+
+    def ms(p):
+        value = scaling.percentile(latencies, p)
+        return None if value is None else 1000 * value
+
+    return dict(
+        requests=len(results),
+        errors=len(results) - len(latencies),
+        throughput=len(latencies) / elapsed,
+        p50=ms(50),
+        p95=ms(95),
+        p99=ms(99),
+        rss=rss,
+    )
+
+
+def summary_table(results):
+    import pyRestTable
+
+    def number(value, fmt=".1f"):
+        return "-" if value is None else f"{value:{fmt}}"
+
+    table = pyRestTable.Table()
+    table.labels = (
+        "scenario requests errors requests/s p50,ms p95,ms p99,ms RSS,MB".split()
+    )
+    for scenario, result in results.items():
+        table.addRow(
+            (
+                scenario,
+                result["requests"],
+                result["errors"],
+                number(result["throughput"]),
+                number(result["p50"]),
+                number(result["p95"]),
+                number(result["p99"]),
+                number(result["rss"] / 2**20, ".0f"),
+            )
+        )
+    return table
+
+
+def compare_table(before, after):
+    import pyRestTable
+
+    table = pyRestTable.Table()
+    table.labels = "scenario measure before after after/before".split()
+    for scenario, result in after["results"].items():
+        old = before["results"].get(scenario)
+        if old is None:
+            continue
+        for measure in "throughput p95 p99 rss errors".split():
+            v0, v1 = old[measure], result[measure]
+            ratio = f"{v1 / v0:.2f}" if v0 and v1 is not None else "-"
+            table.addRow((scenario, measure, v0, v1, ratio))
+    return table
+
+
+def main():
+    import argparse
+    import sys
+    import tempfile
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mix", choices=sorted(MIXES), default="mixed")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=15, help="per scenario")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--runs", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=scaling.PORT)
+    parser.add_argument("--mongo-uri", help="such as mongodb://localhost:27017")
+    parser.add_argument("--mongomock", action="store_true", help="not mongod")
+    parser.add_argument("--output", help="save results to this JSON file")
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two JSON files"
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        before, after = [json.loads(pathlib.Path(f).read_text()) for f in args.compare]
+        print(compare_table(before, after))
+        return
+
+    sys.path.insert(0, str(scaling.HERE))
+    rng = random.Random(args.seed)
+    now = time.time()
+    results = {}
+    with tempfile.TemporaryDirectory() as tempdir:
+        tempdir = pathlib.Path(tempdir)
+        corpus = benchmark.make_corpus(tempdir / "corpus")
+        tree, mongod = catalog_tree(args, tempdir, now)
+        mix = {
+            scenario: weight
+            for scenario, weight in MIXES[args.mix].items()
+            if mongod is not None or args.mongo_uri or scenario not in MONGO_ONLY
+        }
+        config_file = scaling.write_config(tempdir, tempdir / "corpus", [tree])
+        runs = run_summaries(args.runs, tempdir / "frames", now, args.seed)
+        requests = {s: scenario_requests(s, runs, corpus, rng) for s in mix}
+        process = scaling.start_server(
+            config_file,
+            args.workers,
+            port=args.port,
+            env=dict(TILED_SHARED_DIR=str(tempdir / "shared")),
+        )
+        try:
+            everything = [r for s, w in mix.items() for r in requests[s][: 50 * w]]
+            rng.shuffle(everything)
+            scaling.run_load(everything, args.concurrency, 2, args.port)  # warm up
+            phases = [(s, requests[s]) for s in mix if requests[s]]
+            phases.append((f"mix: {args.mix}", everything))
+            for label, routes in phases:
+                load, elapsed = scaling.run_load(
+                    routes, args.concurrency, args.seconds, args.port
+                )
+                rss = scaling.server_rss(process)
+                results[label] = statistics(load, elapsed, rss)
+                print(f"{label}: {results[label]}", flush=True)
+        finally:
+            scaling.stop_server(process)
+            if mongod is not None:
+                mongod.terminate()
+                mongod.wait()
+
+    print(summary_table(results))
+    if args.output:
+        report = dict(
+            environment=benchmark.environment(),
+            arguments={k: v for k, v in vars(args).items() if k != "compare"},
+            results=results,
+        )
+        pathlib.Path(args.output).write_text(json.dumps(report, indent=2))
+        print(f"results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Keep the metadata of each node within a size budget.
+
+Some nodes carry a lot of metadata: the ``PVs`` of an MDA file header
+(often hundreds), the ``info`` & ``exif`` of an image, or the ``UB``
+matrix and ``reflections`` of a SPEC diffractometer.  All of it would be
+sent in every listing page of the directory.
+
+When the metadata of a node (as JSON) is larger than ``BUDGET`` bytes
+(environment variable ``TILED_METADATA_BUDGET``), its largest values
+(sub-trees, lists, long text) are moved out, largest first, until it
+fits.  Each is replaced by a stub::
+
+    {"moved_to": "_metadata", "bytes": 48213}
+
+The moved values are the metadata of a child node, ``_metadata``, of a
+MapAdapter.  An array has no children, so they are kept aside and served
+by ``moved_metadata.py`` (for any node) instead.
+
+As for any node, tiled's own ``select_metadata`` (JMESPath) parameter
+selects the metadata fields returned by ``/api/v1/node/search/{path}``
+and ``/api/v1/node/metadata/{path}``.
+
+Keys that are not text (such as the numbers of unknown EXIF tags) are made
+text, as JSON needs.  Metadata that cannot be measured is kept as it is:
+the budget never makes a file unreadable.
+"""
+
+from tiled.adapters.array import ArrayAdapter
+from tiled.adapters.mapping import MapAdapter
+import logging
+import orjson
+import os
+
+BUDGET = int(os.environ.get("TILED_METADATA_BUDGET", 4096))  # bytes, as JSON
+MOVED_KEY = "_metadata"
+
+logger = logging.getLogger(__name__)
+
+
+def json_size(content):
+    """Size (bytes) of content as JSON, near enough for a budget."""
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    return len(orjson.dumps(content, default=str, option=option))
+
+
+def str_keys(content):
+    """The content, with the keys of all its dictionaries as text."""
+    if isinstance(content, dict):
+        return {str(k): str_keys(v) for k, v in content.items()}
+    if isinstance(content, (list, tuple)):
+        return type(content)(str_keys(v) for v in content)
+    return content
+
+
+def split_metadata(md, budget=None):
+    """
+    Split metadata to fit the budget.
+
+    Returns ``(kept, moved)``: the metadata with stubs and the dictionary of
+    the values moved out.  ``moved`` is empty if ``md`` fits the budget.
+    """
+    budget = BUDGET if budget is None else budget
+    try:
+        md = str_keys(md)
+        total = json_size(md)
+        if total <= budget:
+            return md, {}
+        sizes = {k: json_size(v) for k, v in md.items()}
+    except Exception as exc:  # such as a value that cannot be made JSON
+        logger.warning("metadata kept as it is: %r", exc)
+        return md, {}
+
+    kept, moved = dict(md), {}
+    for key in sorted(sizes, key=sizes.get, reverse=True):
+        if total <= budget:
+            break
+        stub = dict(moved_to=MOVED_KEY, bytes=sizes[key])
+        if sizes[key] <= json_size(stub):
+            break  # the rest is smaller than its stubs would be
+        moved[key] = kept[key]
+        kept[key] = stub
+        total -= sizes[key] - json_size(stub)
+    return kept, moved
+
+
+def map_adapter(mapping, metadata, **kwargs):
+    """MapAdapter, with any metadata beyond the budget in a child node."""
+    kept, moved = split_metadata(metadata)
+    if len(moved) > 0:
+        mapping = dict(mapping)
+        mapping[MOVED_KEY] = MapAdapter({}, metadata=moved)
+    adapter = MapAdapter(mapping, metadata=kept, **kwargs)
+    adapter.moved_metadata = moved
+    return adapter
+
+
+def array_adapter(array, metadata, **kwargs):
+    """ArrayAdapter, with any metadata beyond the budget kept aside."""
+    kept, moved = split_metadata(metadata)
+    adapter = ArrayAdapter.from_array(array, metadata=kept, **kwargs)
+    adapter.moved_metadata = moved
+    return adapter
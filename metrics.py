@@ -0,0 +1,228 @@
+"""
+Timing instrumentation of the custom readers, in Prometheus text format.
+
+Enable with environment variable ``TILED_READER_METRICS=1`` (before the
+server starts).  When not enabled, ``timed()`` returns the function
+unchanged and ``count()`` returns at once, so there is no overhead.
+
+Collected:
+
+* histograms of time spent, by stage, mimetype and function:
+
+  - ``detect``: ``custom.detect_mimetype`` (mimetype is its result)
+  - ``read``: the reader functions (``read_spec_data``, ``read_mda``, ...)
+  - ``metadata``: metadata construction (``interpret_exif``, ...)
+  - ``respond``: complete server responses, by route (which
+    includes serialization), mimetype is the response's media type
+
+* counters of failures in the mimetype probe (``isHdf5``, NeXus files too)
+* the slowest files seen
+
+With several worker processes (see ``shared.py``), each worker writes its
+metrics to the shared directory (every ``SHARE_INTERVAL`` seconds, and
+when it serves these routes), and the routes merge those of all workers.
+
+Served by ``reader_routes.py``::
+
+    /api/v1/readers/metrics     Prometheus text format
+    /api/v1/readers/slowest     JSON
+"""
+
+import functools
+import heapq
+import logging
+import os
+import shared
+import threading
+import time
+
+ENABLED = os.environ.get("TILED_READER_METRICS", "0") not in ("", "0")
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+NUMBER_SLOWEST = 20
+PREFIX = "tiled_reader"
+SHARE_INTERVAL = 5  # seconds, between the metrics files of each worker
+
+logger = logging.getLogger(__name__)
+_lock = threading.Lock()
+_histograms = {}  # (stage, mimetype, function): [count per bucket..., sum]
+_counters = {}  # (name, sorted labels): count
+_slowest = []  # heap of (seconds, stage, mimetype, filename)
+
+
+def observe(stage, mimetype, function, seconds, filename=None):
+    """Record the time spent in one call."""
+    key = (stage, str(mimetype), function)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        for i, le in enumerate(BUCKETS):
+            if seconds <= le:
+                histogram[i] += 1
+                break
+        else:
+            histogram[len(BUCKETS)] += 1  # +Inf
+        histogram[-1] += seconds
+
+        if filename is not None:
+            item = (seconds, stage, str(mimetype), str(filename))
+            if len(_slowest) < NUMBER_SLOWEST:
+                heapq.heappush(_slowest, item)
+            elif item > _slowest[0]:
+                heapq.heapreplace(_slowest, item)
+
+
+def count(name, **labels):
+    """Increment a counter, such as ``count("probe_failures", probe="isHdf5")``."""
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + 1
+
+
+def timed(stage, mimetype=None):
+    """
+    Decorator: time each call of the function in this stage.
+
+    The first argument, if it is a file name, is used for the list of
+    slowest files.  Without a ``mimetype``, a text result is used (as
+    from ``detect_mimetype``), or ``error`` for the calls that raise.
+    """
+
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            label = "error"  # unless it returns
+            try:
+                result = func(*args, **kwargs)
+                label = result if isinstance(result, str) else "unknown"
+                return result
+            finally:
+                seconds = time.perf_counter() - t0
+                filename = None
+                if len(args) > 0 and isinstance(args[0], (str, os.PathLike)):
+                    filename = args[0]
+                label = label if mimetype is None else mimetype
+                observe(stage, label, func.__name__, seconds, filename)
+
+        return wrapper
+
+    return decorator
+
+
+def install_middleware(app):
+    """Time all server responses (stage ``respond``), if enabled."""
+    if not ENABLED:
+        return
+
+    @app.middleware("http")
+    async def time_response(request, call_next):
+        t0 = time.perf_counter()
+        response = await call_next(request)
+        parts = request.url.path.split("/")
+        route = "/".join(parts[3:4]) if parts[1:3] == ["api", "v1"] else "other"
+        media_type = response.headers.get("content-type", "").split(";")[0]
+        observe("respond", media_type, route, time.perf_counter() - t0)
+        return response
+
+
+def snapshot():
+    """The metrics of this process, as JSON content."""
+    with _lock:
+        return dict(
+            histograms=[[list(key), list(v)] for key, v in _histograms.items()],
+            counters=[
+                [name, list(labels), n] for (name, labels), n in _counters.items()
+            ],
+            slowest=list(_slowest),
+        )
+
+
+def merge(snapshots):
+    """Histograms, counters & slowest files of all these snapshots."""
+    histograms, counters, slowest = {}, {}, []
+    for content in snapshots:
+        for key, values in content["histograms"]:
+            total = histograms.get(tuple(key), [0] * len(values))
+            histograms[tuple(key)] = [a + b for a, b in zip(total, values)]
+        for name, labels, n in content["counters"]:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + n
+        slowest += [tuple(item) for item in content["slowest"]]
+    return histograms, counters, heapq.nlargest(NUMBER_SLOWEST, slowest)
+
+
+def share():
+    """Write the metrics of this worker for the others (its name: the server's)."""
+    shared.write_json(f"metrics-{os.getppid()}-{os.getpid()}", snapshot())
+
+
+def collected():
+    """The metrics of this process, or of all the server's workers."""
+    if not shared.ENABLED:
+        return merge([snapshot()])
+    share()
+    return merge(shared.read_json(f"metrics-{os.getppid()}-*"))
+
+
+def start_sharing():
+    """Write the metrics of this worker every SHARE_INTERVAL (server startup)."""
+
+    def run():
+        while True:
+            time.sleep(SHARE_INTERVAL)
+            try:
+                share()
+            except OSError as exc:
+                logger.warning("metrics: %s", exc)
+
+    if ENABLED and shared.ENABLED:
+        threading.Thread(target=run, daemon=True).start()
+
+
+def _labels(**labels):
+    def escape(value):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        return value.replace("\n", "\\n")
+
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def render(histograms, counters, slowest):
+    """These metrics (as from ``collected()``), as Prometheus text."""
+    name = f"{PREFIX}_seconds"
+    lines = [
+        f"# HELP {name} Time spent in the custom readers.",
+        f"# TYPE {name} histogram",
+    ]
+    for (stage, mimetype, function), histogram in sorted(histograms.items()):
+        labels = dict(stage=stage, mimetype=mimetype, function=function)
+        cumulative = 0
+        for le, n in zip(BUCKETS + ("+Inf",), histogram[:-1]):
+            cumulative += n
+            lines.append(f"{name}_bucket{_labels(**labels, le=le)} {cumulative}")
+        lines.append(f"{name}_sum{_labels(**labels)} {histogram[-1]}")
+        lines.append(f"{name}_count{_labels(**labels)} {cumulative}")
+
+    for counter in sorted(set(k[0] for k in counters)):
+        name = f"{PREFIX}_{counter}_total"
+        lines += [f"# TYPE {name} counter"]
+        for (c, labels), n in sorted(counters.items()):
+            if c == counter:
+                lines.append(f"{name}{_labels(**dict(labels))} {n}")
+
+    name = f"{PREFIX}_slowest_seconds"
+    lines += [
+        f"# HELP {name} The slowest files seen.",
+        f"# TYPE {name} gauge",
+    ]
+    for rank, (seconds, stage, mimetype, filename) in enumerate(slowest, start=1):
+        labels = _labels(rank=rank, stage=stage, mimetype=mimetype, file=filename)
+        lines.append(f"{name}{labels} {seconds}")
+    return "\n".join(lines) + "\n"
+
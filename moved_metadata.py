@@ -0,0 +1,47 @@
+"""
+Metadata moved out of a node to keep it within the size budget.
+
+See ``metadata_budget.py``.  Served (see ``server.py``) for any node::
+
+    /api/v1/moved_metadata/{path}
+    /api/v1/moved_metadata/{path}?select_metadata=PVs
+"""
+
+from fastapi import APIRouter
+from fastapi import HTTPException
+from fastapi import Query
+from fastapi import Response
+from metadata_budget import MOVED_KEY
+from tiled.server.dependencies import SecureEntry
+import orjson
+
+router = APIRouter()
+
+
+@router.get("/moved_metadata/{path:path}")
+def moved_metadata(
+    path: str,
+    select_metadata: str = Query(None, description="JMESPath, as tiled's"),
+    entry=SecureEntry(scopes=["read:metadata"]),
+):
+    moved = getattr(entry, "moved_metadata", None)
+    if moved is None:
+        moved = {}
+        if entry.structure_family == "node" and MOVED_KEY in entry:
+            moved = dict(entry[MOVED_KEY].metadata)
+    if select_metadata is not None:
+        import jmespath
+
+        try:
+            moved = jmespath.compile(select_metadata).search(moved)
+        except jmespath.exceptions.JMESPathError as err:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Malformed 'select_metadata' parameter: {err}",
+            )
+    content = orjson.dumps(
+        dict(path=path, metadata=moved),
+        default=str,
+        option=orjson.OPT_SERIALIZE_NUMPY,
+    )
+    return Response(content, media_type="application/json")
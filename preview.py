@@ -0,0 +1,256 @@
+"""
+Quick-look previews of image and detector data: binned levels & thumbnails.
+
+Served (see ``server.py``) for any array node, such as the images from
+``image_data.read_image`` or the ``adsimdet_image`` of a bluesky run::
+
+    /api/v1/preview/{path}                   thumbnail, PNG
+    /api/v1/preview/{path}?format=webp       thumbnail, WebP
+    /api/v1/preview/{path}?level=4           binned 4x4, PNG
+    /api/v1/preview/{path}?level=4&format=npy  binned 4x4, as numpy .npy
+
+Levels and thumbnails of the nodes of files are computed once and cached
+on disk (``CACHE_DIR``), by the size & modification time of the file.
+Those of other nodes (such as bluesky runs) are computed each time.
+"""
+
+from fastapi import APIRouter
+from fastapi import HTTPException
+from fastapi import Query
+from fastapi import Response
+from tiled.server.dependencies import SecureEntry
+import catalogs
+import hashlib
+import io
+import numpy
+import os
+import pathlib
+import tempfile
+
+ROOT = pathlib.Path(__file__).parent
+CACHE_DIR = pathlib.Path(os.environ.get("TILED_PREVIEW_CACHE", ROOT / ".preview_cache"))
+LEVELS = (2, 4, 8)  # binning factors, each level is binned 2x2 from the previous
+THUMBNAIL_SIZE = 256  # pixels, longest side
+FORMATS = {
+    # format: (PIL format, media type)
+    "npy": (None, "application/octet-stream"),
+    "png": ("PNG", "image/png"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+router = APIRouter()
+
+
+def is_color(metadata):
+    """Is this a color image (by its PIL ``mode``, as from read_image)?"""
+    from PIL import Image
+
+    mode = (metadata or {}).get("mode")
+    if not isinstance(mode, str):
+        return False  # such as a stack of detector frames
+    try:
+        return Image.getmodebands(mode) > 1
+    except (KeyError, ValueError):
+        return False
+
+
+def frame_index(shape, color=False):
+    """Index of one 2-D frame (or color frame) within an array of this shape."""
+    if len(shape) < 2:
+        raise ValueError(f"Cannot preview array of shape {shape}")
+    if color and len(shape) == 3:
+        return ()  # read_image puts the colors first
+    return (0,) * (len(shape) - 2)  # first frame, e.g. adsimdet_image [1, 1, 1024, 1024]
+
+
+def as_frame(arr, color=False):
+    """Return the array as 2-D frame (rows, columns[, colors])."""
+    arr = numpy.asarray(arr)
+    arr = arr[frame_index(arr.shape, color)]
+    if arr.ndim == 3:
+        arr = numpy.moveaxis(arr, 0, -1)  # put the colors last
+    return arr
+
+
+def bin_frame(frame, factor):
+    """Bin a frame by ``factor`` x ``factor`` pixels (mean), trimming any excess."""
+    rows, cols = frame.shape[0] // factor, frame.shape[1] // factor
+    if rows == 0 or cols == 0:
+        raise ValueError(f"Cannot bin frame of shape {frame.shape} by {factor}")
+    frame = frame[: rows * factor, : cols * factor]
+    shape = (rows, factor, cols, factor) + frame.shape[2:]
+    return frame.reshape(shape).mean(axis=(1, 3))
+
+
+def pyramid(frame, levels=LEVELS):
+    """
+    Dictionary of binned frames, each level binned from the one before.
+
+    Levels that would be smaller than one pixel (on either side) are left out.
+    """
+    result = {}
+    previous, binned = 1, frame
+    for factor in sorted(levels):
+        if factor % previous != 0:
+            previous, binned = 1, frame
+        if min(binned.shape[:2]) < factor // previous:
+            break
+        binned = bin_frame(binned, factor // previous)
+        result[factor] = binned
+        previous = factor
+    return result
+
+
+def to_uint8(frame):
+    """Scale a frame to the full 0..255 range of 8-bit pixels."""
+    frame = numpy.asarray(frame, dtype=float)
+    finite = numpy.isfinite(frame)
+    if not finite.any():
+        return numpy.zeros(frame.shape, dtype="uint8")
+    lo, hi = frame[finite].min(), frame[finite].max()
+    scale = 255 / (hi - lo) if hi > lo else 0
+    frame = numpy.where(finite, frame - lo, 0) * scale
+    return frame.clip(0, 255).astype("uint8")
+
+
+def encode(frame, format="png", size=None):
+    """Encode a frame as image file content (bytes), optionally as thumbnail."""
+    from PIL import Image
+
+    pil_format, _media_type = FORMATS[format]
+    if pil_format is None:
+        buffer = io.BytesIO()
+        numpy.save(buffer, frame)
+        return buffer.getvalue()
+
+    pixels = to_uint8(frame)
+    if pixels.ndim == 3 and pixels.shape[-1] == 4:
+        image = Image.fromarray(pixels, mode="RGBA")
+    elif pixels.ndim == 3 and pixels.shape[-1] == 3:
+        image = Image.fromarray(pixels, mode="RGB")
+    elif pixels.ndim == 3:
+        image = Image.fromarray(pixels[..., 0], mode="L")  # such as "LA"
+    else:
+        image = Image.fromarray(pixels, mode="L")
+    if size is not None:
+        image.thumbnail((size, size))
+    buffer = io.BytesIO()
+    image.save(buffer, format=pil_format)
+    return buffer.getvalue()
+
+
+def signature(entry, path):
+    """Identify the content of an array node, for the cache (``None``: no file)."""
+    filename = catalogs.file_of(path)
+    if filename is None:
+        return None
+    try:
+        stat = filename.stat()
+    except OSError:
+        return None
+    shape = entry.macrostructure().shape
+    return f"{shape} {filename} {stat.st_size} {stat.st_mtime_ns}"
+
+
+def cache_dir(path, sig):
+    key = hashlib.sha1(f"{path}|{sig}".encode()).hexdigest()
+    return CACHE_DIR / key[:2] / key
+
+
+def write_atomic(filename, content):
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        dir=filename.parent, prefix=f".{filename.name}.", delete=False
+    ) as file:
+        file.write(content)
+    os.replace(file.name, filename)
+
+
+def levels_of(entry):
+    """The first frame of the array node, and its binned levels."""
+    shape = entry.macrostructure().shape
+    color = is_color(entry.metadata)
+    frame = as_frame(entry.read(slice=frame_index(shape, color)), color)
+    return frame, pyramid(frame)
+
+
+def encode_preview(frame, levels, level=0, format="png"):
+    """Encode the thumbnail (level 0) or a binned level of the frame."""
+    if level == 0:
+        # from the smallest level that is still large enough
+        candidates = [frame] + [levels[factor] for factor in sorted(levels)]
+        candidates = [c for c in candidates if max(c.shape[:2]) >= THUMBNAIL_SIZE]
+        source = candidates[-1] if len(candidates) > 0 else frame
+        return encode(source, format, THUMBNAIL_SIZE)
+    if level not in levels:
+        raise ValueError(f"Frame {frame.shape[:2]} is too small for level {level}")
+    return encode(levels[level], format)
+
+
+def make_preview(entry, path, level=0, format="png"):
+    """Return preview (bytes) of the array node, from the cache when possible."""
+    sig = signature(entry, path)
+    if sig is None:
+        return encode_preview(*levels_of(entry), level, format)
+    directory = cache_dir(path, sig)
+    name = f"thumbnail.{format}" if level == 0 else f"L{level}.{format}"
+    cached = directory / name
+    if cached.exists():
+        return cached.read_bytes()
+
+    binned_file = directory / f"L{level}.npy"
+    if level != 0 and binned_file.exists():
+        write_atomic(cached, encode(numpy.load(binned_file), format))
+        return cached.read_bytes()
+
+    frame, levels = levels_of(entry)
+    for factor, binned in levels.items():
+        write_atomic(directory / f"L{factor}.npy", encode(binned, "npy"))
+    write_atomic(directory / f"thumbnail.{format}", encode_preview(frame, levels, 0, format))
+
+    if not cached.exists():
+        write_atomic(cached, encode_preview(frame, levels, level, format))
+    return cached.read_bytes()
+
+
+@router.get("/preview/{path:path}")
+def preview(
+    path: str,
+    level: int = Query(0, description=f"0: thumbnail, or binning factor: {LEVELS}"),
+    format: str = Query("png", description=f"one of: {list(FORMATS)}"),
+    entry=SecureEntry(scopes=["read:data"]),
+):
+    if entry.structure_family != "array":
+        raise HTTPException(status_code=400, detail=f"{path!r} is not an array")
+    if level != 0 and level not in LEVELS:
+        raise HTTPException(status_code=400, detail=f"level must be 0 or one of {LEVELS}")
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {list(FORMATS)}")
+    if level == 0 and format == "npy":
+        raise HTTPException(status_code=400, detail="thumbnails are images, not npy")
+    try:
+        content = make_preview(entry, path, level=level, format=format)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return Response(
+        content,
+        media_type=FORMATS[format][1],
+        headers={"Cache-Control": "max-age=3600"},
+    )
+
+
+def main():
+    from image_data import read_image
+
+    testdir = ROOT / "data" / "images"
+    for filepath in sorted(testdir.iterdir()):
+        adapter = read_image(filepath)
+        if adapter.structure_family != "array":
+            continue
+        frame = as_frame(adapter.read(), is_color(adapter.metadata))
+        thumbnail = encode(frame, "png", THUMBNAIL_SIZE)
+        print(f"{filepath.name}: {frame.shape=} thumbnail={len(thumbnail)} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Routes of the state kept by the readers: unrecognized & excluded files,
+metrics.
+
+The readers (and ``custom.py``) do not import the server, so their routes
+are here.  As tiled's own routes, they need an authenticated client (unless
+the server is public), and list only the files of the file trees that
+client may read (see ``catalogs.access_check``), by node path.  Served (see
+``server.py``)::
+
+    /api/v1/unrecognized
+    /api/v1/unrecognized?reason=unreadable&limit=100
+    /api/v1/readers/metrics     Prometheus text format
+    /api/v1/readers/slowest     JSON
+    /api/v1/excluded
+"""
+
+from fastapi import APIRouter
+from fastapi import HTTPException
+from fastapi import Query
+from fastapi import Response
+import catalogs
+import exclude
+import metrics
+import unrecognized
+
+router = APIRouter()
+
+
+def readable_files(readable, items):
+    """The items of the files the client may read, by node path (no filename)."""
+    for item in items:
+        path = catalogs.node_path(item.pop("filename"))
+        if path is not None and readable(path.split("/")[0]):
+            yield dict(path=path, **item)
+
+
+def readable_slowest(readable, slowest):
+    """The slowest files (as from ``metrics.collected()``) the client may read."""
+    for seconds, stage, mimetype, filename in slowest:
+        path = catalogs.node_path(filename)
+        if path is not None and readable(path.split("/")[0]):
+            yield seconds, stage, mimetype, path
+
+
+@router.get("/unrecognized")
+def unrecognized_files(
+    reason: str = Query(None, description="such as: unrecognized, unreadable"),
+    limit: int = Query(100, ge=1),
+    readable=catalogs.access_check(),
+):
+    files = list(readable_files(readable, unrecognized.query(reason)))
+    return dict(total=len(files), files=files[:limit])
+
+
+@router.get("/readers/metrics")
+def readers_metrics(readable=catalogs.access_check()):
+    histograms, counters, slowest = metrics.collected()
+    slowest = list(readable_slowest(readable, slowest))
+    content = metrics.render(histograms, counters, slowest)
+    return Response(content, media_type="text/plain; version=0.0.4")
+
+
+@router.get("/readers/slowest")
+def readers_slowest(readable=catalogs.access_check()):
+    slowest = readable_slowest(readable, metrics.collected()[2])
+    return dict(
+        enabled=metrics.ENABLED,
+        slowest=[
+            dict(seconds=seconds, stage=stage, mimetype=mimetype, path=path)
+            for seconds, stage, mimetype, path in slowest
+        ],
+    )
+
+
+@router.get("/excluded")
+def excluded_counts(readable=catalogs.access_check()):
+    if not any(readable(tree) for tree in catalogs.file_trees()):
+        raise HTTPException(status_code=404, detail="No file trees")
+    return exclude.excluded_counts()
+
+
+@router.on_event("startup")
+def start_sharing():
+    metrics.start_sharing()
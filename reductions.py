@@ -0,0 +1,248 @@
+"""
+Server-side reductions of array nodes, computed block by block.
+
+Served (see ``server.py``) for any array node, such as the images from
+``image_data.read_image``, the detectors of ``synApps_mda.read_mda`` or
+the data of a bluesky stream::
+
+    /api/v1/reduce/{path}?reduce=sum&axis=0
+    /api/v1/reduce/{path}?reduce=mean&axis=0&slice=10:20,100:200,::2
+    /api/v1/reduce/{path}?reduce=max&format=application/octet-stream
+    /api/v1/reduce/{path}?reduce=mean&bin=1,4,4
+
+Only one block (chunk) of the array is read into memory at a time,
+then combined into the (much smaller) result.  The ``slice`` is applied
+before the reduction and uses numpy syntax (as tiled's own ``slice``).
+Without an ``axis``, the reduction is over all axes.  With ``bin`` (one
+factor for all axes, or one for each axis after slicing), each bin of
+that many elements is reduced instead; any excess at the end of an axis
+is trimmed.
+"""
+
+from fastapi import APIRouter
+from fastapi import HTTPException
+from fastapi import Query
+from fastapi import Response
+from tiled.server.dependencies import SecureEntry
+import itertools
+import numpy
+import orjson
+
+REDUCTIONS = "sum mean min max".split()
+
+router = APIRouter()
+
+
+def parse_slice(text, shape):
+    """
+    Parse the ``slice`` parameter (such as ``"0,10:20,::2"``) for this shape.
+
+    Returns a list with an ``int`` or a normalized ``slice`` for every axis.
+    """
+    items = [] if text in (None, "") else text.split(",")
+    if len(items) > len(shape):
+        raise ValueError(f"slice {text!r} has more axes than shape {shape}")
+    items += [":"] * (len(shape) - len(items))
+    result = []
+    for item, n in zip(items, shape):
+        item = item.strip()
+        if ":" not in item:
+            index = int(item)
+            if not -n <= index < n:
+                raise ValueError(f"index {index} is out of range for axis of size {n}")
+            result.append(index % n)
+            continue
+        parts = [int(p) if p.strip() else None for p in item.split(":")]
+        if len(parts) > 3:
+            raise ValueError(f"Cannot parse slice {item!r}")
+        start, stop, step = slice(*parts).indices(n)
+        if step < 1:
+            raise ValueError(f"slice {item!r} must have a positive step")
+        result.append(slice(start, max(start, stop), step))
+    return result
+
+
+def sliced_length(s):
+    return len(range(s.start, s.stop, s.step))
+
+
+def block_selection(selection, offsets, sizes):
+    """
+    Selection within one block and where it lands in the sliced array.
+
+    Returns ``(local, position)`` tuples (or ``None`` when the block is not
+    selected).  Integer indices are kept in ``local`` but not in ``position``.
+    """
+    local, position = [], []
+    for s, b0, size in zip(selection, offsets, sizes):
+        b1 = b0 + size
+        if isinstance(s, int):
+            if not b0 <= s < b1:
+                return None
+            local.append(s - b0)
+            continue
+        if s.start >= b0:
+            first = s.start
+        else:
+            first = s.start + -(-(b0 - s.start) // s.step) * s.step  # round up
+        last = min(b1, s.stop)
+        if first >= last:
+            return None
+        local.append(slice(first - b0, last - b0, s.step))
+        i0 = (first - s.start) // s.step
+        position.append(slice(i0, i0 + len(range(first, last, s.step))))
+    return tuple(local), tuple(position)
+
+
+def parse_bin(text, shape):
+    """Parse the ``bin`` parameter (such as ``"1,4,4"``): a factor for each axis."""
+    try:
+        factors = [int(item) for item in text.split(",")]
+    except ValueError:
+        raise ValueError(f"Cannot parse bin {text!r}")
+    if len(factors) == 1:
+        factors *= len(shape)
+    if len(factors) != len(shape):
+        raise ValueError(f"bin {text!r} needs 1 or {len(shape)} factors (shape {shape})")
+    if min(factors) < 1:
+        raise ValueError(f"bin {text!r} factors must be positive")
+    if any(n < f for n, f in zip(shape, factors)):
+        raise ValueError(f"bin {text!r} is larger than the sliced shape {shape}")
+    return factors
+
+
+def bin_partial(data, position, factors, n_bins, ufunc):
+    """
+    Reduce the data of one block into the bins it contributes to.
+
+    ``position`` (slices) is where the data lands in the sliced array.
+    Returns ``(partial, bins)``, with ``bins`` the slices of the bins in the
+    result, or ``None`` when the data is all in the trimmed excess.
+    """
+    bins = []
+    for axis, (p, f, n) in enumerate(zip(position, factors, n_bins)):
+        stop = min(p.stop, n * f)  # excess after the last whole bin is trimmed
+        if stop <= p.start:
+            return None
+        data = data[(slice(None),) * axis + (slice(0, stop - p.start),)]
+        first, last = p.start // f, (stop - 1) // f
+        starts = [0] + [k * f - p.start for k in range(first + 1, last + 1)]
+        data = ufunc.reduceat(data, starts, axis=axis)
+        bins.append(slice(first, last + 1))
+    return data, tuple(bins)
+
+
+def blocks(chunks):
+    """Iterate ``(block, offsets, sizes)`` over all blocks of the chunks."""
+    starts = [numpy.cumsum((0,) + tuple(c))[:-1] for c in chunks]
+    for block in itertools.product(*[range(len(c)) for c in chunks]):
+        offsets = [int(starts[axis][b]) for axis, b in enumerate(block)]
+        sizes = [chunks[axis][b] for axis, b in enumerate(block)]
+        yield block, offsets, sizes
+
+
+def reduce_blocks(read_block, chunks, reduce="sum", axis=None, slice=None, bin=None):
+    """
+    Reduce an array (or its bins), reading it one block at a time.
+
+    ``read_block(block, slice)`` returns the (sliced) content of one block,
+    as ``ArrayAdapter.read_block()``.
+    """
+    if reduce not in REDUCTIONS:
+        raise ValueError(f"reduce must be one of {REDUCTIONS}, not {reduce!r}")
+    shape = tuple(sum(c) for c in chunks)
+    selection = parse_slice(slice, shape)
+    sliced_shape = tuple(sliced_length(s) for s in selection if not isinstance(s, int))
+    if axis is not None:
+        if not -len(sliced_shape) <= axis < len(sliced_shape):
+            raise ValueError(f"axis {axis} is out of range for sliced shape {sliced_shape}")
+        axis %= len(sliced_shape)
+        out_shape = sliced_shape[:axis] + sliced_shape[axis + 1 :]
+    else:
+        out_shape = ()
+    if 0 in sliced_shape:
+        raise ValueError(f"Nothing selected, sliced shape is {sliced_shape}")
+    factors = None
+    if bin is not None:
+        if axis is not None:
+            raise ValueError("Use either 'axis' or 'bin', not both.")
+        factors = parse_bin(bin, sliced_shape)
+        out_shape = tuple(n // f for n, f in zip(sliced_shape, factors))
+
+    op = {"sum": numpy.sum, "mean": numpy.sum, "min": numpy.min, "max": numpy.max}[reduce]
+    combine = {
+        "sum": numpy.add, "mean": numpy.add, "min": numpy.minimum, "max": numpy.maximum
+    }[reduce]
+    result = None
+    for block, offsets, sizes in blocks(chunks):
+        found = block_selection(selection, offsets, sizes)
+        if found is None:
+            continue
+        local, position = found
+        data = numpy.asarray(read_block(block, local))
+        if factors is not None:
+            found = bin_partial(data, position, factors, out_shape, combine)
+            if found is None:
+                continue
+            partial, position = found
+        elif axis is not None:
+            partial = op(data, axis=axis)
+            position = position[:axis] + position[axis + 1 :]
+        else:
+            partial, position = op(data), ()
+        if result is None:
+            result = numpy.zeros(out_shape, dtype=partial.dtype)
+            filled = numpy.zeros(out_shape, dtype=bool)
+        region = result[position] if len(position) > 0 else result[()]
+        seen = filled[position] if len(position) > 0 else filled[()]
+        # first contribution to a region is copied, others are combined
+        merged = numpy.where(seen, combine(region, partial), partial)
+        if len(position) > 0:
+            result[position] = merged
+            filled[position] = True
+        else:
+            result, filled = numpy.asarray(merged), numpy.asarray(True)
+
+    if reduce == "mean":
+        if factors is not None:
+            count = numpy.prod(factors)
+        elif axis is not None:
+            count = sliced_shape[axis]
+        else:
+            count = numpy.prod(sliced_shape)
+        result = result / count
+    return result
+
+
+@router.get("/reduce/{path:path}")
+def reduce(
+    path: str,
+    reduce: str = Query("sum", description=f"one of: {REDUCTIONS}"),
+    axis: int = Query(None, description="axis (after slicing) to reduce, default: all"),
+    slice: str = Query(None, regex="^[-0-9,: ]*$", description="numpy-style, before reducing"),
+    bin: str = Query(None, regex="^[0-9,]*$", description="factor(s), such as 1,4,4"),
+    format: str = Query("application/json", description="or: application/octet-stream"),
+    entry=SecureEntry(scopes=["read:data"]),
+):
+    if entry.structure_family != "array":
+        raise HTTPException(status_code=400, detail=f"{path!r} is not an array")
+    chunks = entry.macrostructure().chunks
+    try:
+        result = reduce_blocks(
+            entry.read_block, chunks, reduce=reduce, axis=axis, slice=slice, bin=bin
+        )
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+    headers = {"X-Shape": ",".join(map(str, result.shape)), "X-Dtype": result.dtype.str}
+    if format == "application/octet-stream":
+        content = numpy.ascontiguousarray(result).tobytes()
+        return Response(content, media_type=format, headers=headers)
+    if format != "application/json":
+        raise HTTPException(status_code=406, detail=f"format {format!r} not supported")
+    content = dict(shape=list(result.shape), dtype=result.dtype.str, data=result.tolist())
+    return Response(
+        orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY),
+        media_type="application/json",
+        headers=headers,
+    )
@@ -0,0 +1,312 @@
+"""
+Registry of the custom file formats, with their heavy imports deferred.
+
+Each format declares its mimetype, file extensions, and a test of the
+first bytes of a file (its signature).  The signatures need no imports.
+The format of a file's extension is tested first, but the extension alone
+never decides.
+Anything heavy (``h5py``, ``hdf5plugin``, ``spec2nexus``, ``PIL``, ``mda``,
+...) is imported only the first time a file of that format is seen: by
+a ``confirm`` test, by ``prepare()``, or by the reader itself.
+
+The readers here (``read_spec_data``, ``read_mda``, ``read_image``) are
+placeholders for those of the reader modules, which are imported at the
+first call.  Name them in ``config.yml``, such as::
+
+    readers_by_mimetype:
+      text/spec_data: registry:read_spec_data
+
+Report the import time of the modules (each in a fresh interpreter) to
+keep the server's cold start short::
+
+    python registry.py
+    python registry.py --target 2.5
+"""
+
+import functools
+import importlib
+import logging
+import pathlib
+import struct
+import threading
+import time
+
+ROOT = pathlib.Path(__file__).parent
+HEAD_SIZE = 4096  # bytes read from the start of a file for the signatures
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+MDA_VERSIONS = (1.2, 1.3, 1.4)
+SPEC_CONTROLS = (b"#F ", b"#E ", b"#D ", b"#C ")
+
+logger = logging.getLogger(__name__)
+imported = {}  # module: seconds, lazy imports so far
+_lock = threading.Lock()
+_prepared = set()
+
+
+class FileFormat:
+    """How to recognize, prepare for, and read one file format."""
+
+    def __init__(
+        self,
+        name,
+        mimetype,
+        extensions=(),
+        signature=None,
+        confirm=None,
+        requires=(),
+        reader=None,
+    ):
+        self.name = name
+        self.mimetype = mimetype
+        self.extensions = list(extensions)
+        self.signature = signature  # signature(head, filename): bool
+        self.confirm = confirm  # "module:function", (filename): bool
+        self.requires = list(requires)  # modules to import before reading
+        self.reader = reader  # "module:function"
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.name!r}, {self.mimetype!r})"
+
+
+def is_spec(head, filename):
+    # as spec2nexus.spec.is_spec_file_with_header, without reading all the file
+    lines = head.splitlines()[: len(SPEC_CONTROLS)]
+    if len(lines) < len(SPEC_CONTROLS):
+        return False
+    return all(line.startswith(c) for line, c in zip(lines, SPEC_CONTROLS))
+
+
+def is_hdf5(head, filename):
+    if head.startswith(HDF5_SIGNATURE):
+        return True
+    # or after a user block of 512, 1024, 2048, ... bytes
+    with open(filename, "rb") as f:
+        f.seek(0, 2)
+        size, offset = f.tell(), 512
+        while offset + len(HDF5_SIGNATURE) <= size:
+            f.seek(offset)
+            if f.read(len(HDF5_SIGNATURE)) == HDF5_SIGNATURE:
+                return True
+            offset *= 2
+    return False
+
+
+def is_mda(head, filename):
+    if len(head) < 12:
+        return False
+    version, _scan_number, rank = struct.unpack(">fii", head[:12])
+    return round(version, 2) in MDA_VERSIONS and 1 <= rank <= 4
+
+
+def is_image(*magic):
+    def tester(head, filename):
+        return any(head.startswith(m) for m in magic)
+
+    return tester
+
+
+def is_webp(head, filename):
+    return head[:4] == b"RIFF" and head[8:12] == b"WEBP"
+
+
+FORMATS = [
+    FileFormat(
+        "SPEC", "text/spec_data", signature=is_spec, reader="spec_data:read_spec_data"
+    ),
+    FileFormat(
+        "NeXus/HDF5",
+        "application/x-hdf5",
+        extensions=".h5 .hdf .hdf5 .nxs".split(),
+        signature=is_hdf5,
+        confirm="custom:isHdf5",
+        requires=["hdf5plugin"],  # compression filters, before reading
+    ),
+    FileFormat(
+        "MDA",
+        "application/x-mda",
+        extensions=[".mda"],
+        signature=is_mda,
+        reader="synApps_mda:read_mda",
+    ),
+    FileFormat(
+        "PNG", "image/png", [".png"], is_image(b"\x89PNG"), reader="image_data:read_image"
+    ),
+    FileFormat(
+        "JPEG",
+        "image/jpeg",
+        ".jpg .jpeg".split(),
+        is_image(b"\xff\xd8\xff"),
+        reader="image_data:read_image",
+    ),
+    FileFormat(
+        "GIF", "image/gif", [".gif"], is_image(b"GIF8"), reader="image_data:read_image"
+    ),
+    FileFormat(
+        "TIFF",
+        "image/tiff",
+        ".tif .tiff".split(),
+        is_image(b"II*\0", b"MM\0*"),
+        reader="image_data:read_image",
+    ),
+    FileFormat(
+        "BMP", "image/bmp", [".bmp"], is_image(b"BM"), reader="image_data:read_image"
+    ),
+    FileFormat(
+        "WebP", "image/webp", [".webp"], is_webp, reader="image_data:read_image"
+    ),
+]
+FORMATS_BY_EXTENSION = {ext: fmt for fmt in FORMATS for ext in fmt.extensions}
+FORMATS_BY_MIMETYPE = {fmt.mimetype: fmt for fmt in FORMATS}
+
+
+def import_module(name):
+    """Import a module, noting the time of a first import."""
+    import sys
+
+    if name in sys.modules:
+        return sys.modules[name]
+    t0 = time.perf_counter()
+    module = importlib.import_module(name)
+    imported[name] = time.perf_counter() - t0
+    logger.info("imported %s in %.3f s", name, imported[name])
+    return module
+
+
+@functools.lru_cache(maxsize=None)
+def import_object(colon_path):
+    module_name, _, attr = colon_path.partition(":")
+    return getattr(import_module(module_name), attr)
+
+
+def detect(filename):
+    """Mimetype of the file from its content, or ``None``."""
+    try:
+        with open(filename, "rb") as f:
+            head = f.read(HEAD_SIZE)
+    except OSError:
+        return None
+    likely = FORMATS_BY_EXTENSION.get(pathlib.Path(filename).suffix.lower())
+    formats = [likely] if likely is not None else []
+    formats += [fmt for fmt in FORMATS if fmt is not likely]
+    for fmt in formats:
+        try:
+            if fmt.signature is None or not fmt.signature(head, filename):
+                continue
+        except (OSError, struct.error):
+            continue
+        if fmt.confirm is None or import_object(fmt.confirm)(filename):
+            return fmt.mimetype
+    return None
+
+
+def prepare(mimetype):
+    """Import, once, what is needed to read this mimetype."""
+    if mimetype in _prepared:
+        return
+    with _lock:
+        fmt = FORMATS_BY_MIMETYPE.get(mimetype)
+        for name in [] if fmt is None else fmt.requires:
+            import_module(name)
+        _prepared.add(mimetype)
+
+
+def lazy_reader(colon_path):
+    """A reader that imports the real one at its first call."""
+
+    def reader(*args, **kwargs):
+        return import_object(colon_path)(*args, **kwargs)
+
+    reader.__name__ = colon_path.partition(":")[2]
+    reader.__doc__ = f"Lazy reader: {colon_path}"
+    return reader
+
+
+read_image = lazy_reader("image_data:read_image")
+read_mda = lazy_reader("synApps_mda:read_mda")
+read_spec_data = lazy_reader("spec_data:read_spec_data")
+
+# modules imported as files are seen (see startup_modules() for the others)
+DEFERRED_MODULES = """
+    h5py hdf5plugin punx.utils spec2nexus.spec PIL.Image mda
+    spec_data synApps_mda image_data
+""".split()
+
+
+def startup_modules():
+    """
+    Modules imported when the server starts.
+
+    ``server``, the modules of its routes (imported by ``server.routers()``,
+    read from its source), ``custom`` and tiled's app.
+    """
+    import ast
+
+    source = ast.parse((ROOT / "server.py").read_text())
+    routers = next(
+        node
+        for node in source.body
+        if isinstance(node, ast.FunctionDef) and node.name == "routers"
+    )
+    route_modules = [
+        alias.name
+        for node in ast.walk(routers)
+        if isinstance(node, ast.Import)
+        for alias in node.names
+    ]
+    return ["server", *route_modules, "custom", "tiled.server.app"]
+
+
+def import_time(module):
+    """Seconds to import the module in a fresh interpreter (``-X importtime``)."""
+    import subprocess
+    import sys
+
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        cwd=ROOT,  # the modules of this directory
+        text=True,
+    )
+    if process.returncode != 0:
+        return None
+    # last line: "import time: self | cumulative | module", in microseconds
+    last = [line for line in process.stderr.splitlines() if "|" in line][-1]
+    return int(last.split("|")[1]) / 1e6
+
+
+def main():
+    import argparse
+    import pyRestTable
+    import sys
+
+    parser = argparse.ArgumentParser(description="Import time profile.")
+    parser.add_argument(
+        "--target", type=float, help="fail if any startup module takes longer (s)"
+    )
+    args = parser.parse_args()
+
+    table = pyRestTable.Table()
+    table.labels = "module when seconds".split()
+    slowest = 0
+    for when, modules in (
+        ("startup", startup_modules()),
+        ("deferred", DEFERRED_MODULES),
+    ):
+        for module in modules:
+            seconds = import_time(module)
+            if seconds is None:
+                table.addRow((module, when, "not available"))
+                continue
+            table.addRow((module, when, f"{seconds:.3f}"))
+            if when == "startup":
+                slowest = max(slowest, seconds)
+    print(table)
+    print(f"startup: {slowest:.3f} s (the modules share most of their imports)")
+
+    if args.target is not None and slowest > args.target:
+        print(f"startup import time exceeds target of {args.target} s")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
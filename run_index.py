@@ -0,0 +1,253 @@
+"""
+In-memory index of each catalog's runs by uid (prefix) and by scan_id.
+
+A lookup by uid prefix (the 7 characters shown by ``utils.run_summary_table``)
+or by scan_id is a regex or unindexed query in MongoDB.  Here, each catalog
+has a sorted array of all its uids (binary search for a prefix) and a
+dictionary of scan_id to uids.  The index is loaded (from the ``run_start``
+collection) when the server starts, then new runs are added as they arrive
+(polled every ``POLL_INTERVAL`` seconds).  The ``_id`` of a document is made
+by the client that inserts it, so a run may arrive with an ``_id`` older
+than one already seen (another host, clock skew): each poll looks again at
+the last ``RECHECK`` seconds of ``_id``, and at all runs when the collection
+has more runs than the index.
+
+With several worker processes (see ``shared.py``), one worker keeps the
+index current and writes a snapshot after each change; the others map
+the snapshot into memory (``by_scan_id`` then uses a sorted table of
+scan_id & uid).  If that worker ends, another one takes over.
+
+Served (see ``server.py``), to clients that may read the catalog::
+
+    /api/v1/runs/{catalog}/uid/{prefix}
+    /api/v1/runs/{catalog}/scan_id/{scan_id}
+    /api/v1/runs/{catalog}/index
+"""
+
+from fastapi import APIRouter
+from fastapi import HTTPException
+from fastapi import Query
+from tiled.server.dependencies import SecureEntry
+import catalogs
+import datetime
+import logging
+import numpy
+import shared
+import threading
+import time
+
+POLL_INTERVAL = 5  # seconds
+RECHECK = 600  # seconds of _id (by its timestamp) looked at again by each poll
+PROJECTION = {"_id": 1, "uid": 1, "scan_id": 1}
+
+logger = logging.getLogger(__name__)
+indexes = {}  # catalog: RunIndex
+
+router = APIRouter()
+
+
+class RunIndex:
+    """Sorted uids & scan_id lookup of one catalog's runs."""
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.uids = numpy.array([], dtype="S36")
+        self.scan_ids = {}  # scan_id: [uid, ...] in order of arrival
+        self.last_id = None  # MongoDB _id of the most recent run_start
+        self.counted = None  # documents in run_start, at the last full pass
+        self.loaded = False
+        self.scan_table = None  # sorted (scan_id, uid), from a shared snapshot
+        self.snapshot = None  # mtime of the shared snapshot
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.uids)
+
+    def add(self, documents):
+        """Add the run_start documents (in order of _id) not yet indexed."""
+        found = {}  # uid: scan_id
+        for doc in documents:
+            found.setdefault(doc["uid"], doc.get("scan_id"))
+            if self.last_id is None or doc["_id"] > self.last_id:
+                self.last_id = doc["_id"]
+        if len(found) > 0 and len(self.uids) > 0:
+            keys = numpy.array(list(found), dtype="S")
+            i = numpy.searchsorted(self.uids, keys).clip(max=len(self.uids) - 1)
+            known = self.uids[i] == keys
+            found = {uid: v for (uid, v), old in zip(found.items(), known) if not old}
+        if len(found) == 0:
+            return
+        scan_ids = {}
+        for uid, scan_id in found.items():
+            scan_ids.setdefault(scan_id, []).append(uid)
+        new = numpy.sort(numpy.array(list(found), dtype="S"))
+        uids = self.uids.astype(numpy.promote_types(self.uids.dtype, new.dtype))
+        uids = numpy.insert(uids, numpy.searchsorted(uids, new), new)
+        with self._lock:  # replace, so lookups never see a partial update
+            self.uids = uids
+            for scan_id, found in scan_ids.items():
+                self.scan_ids[scan_id] = self.scan_ids.get(scan_id, []) + found
+
+    def update(self, collection):
+        """Add runs that arrived since the last update (or all of them)."""
+        if self.last_id is None:
+            query = {}
+        else:
+            query = {"_id": {"$gt": recheck_from(self.last_id)}}
+        self.add(collection.find(query, PROJECTION).sort("_id", 1))
+        if self.loaded:
+            count = collection.estimated_document_count()
+            if count > len(self) and count != self.counted:
+                # some run arrived with an _id older than RECHECK: all again
+                self.add(collection.find({}, PROJECTION).sort("_id", 1))
+                self.counted = count
+        self.loaded = True
+
+    def by_prefix(self, prefix, limit=None):
+        """Uids that start with this prefix."""
+        uids = self.uids
+        key = prefix.encode()
+        lo = numpy.searchsorted(uids, key, side="left")
+        hi = numpy.searchsorted(uids, key + b"\xff", side="left")
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        return [uid.decode() for uid in uids[lo:hi]]
+
+    def by_scan_id(self, scan_id):
+        """Uids of runs with this scan_id, in order of arrival."""
+        table = self.scan_table
+        if table is not None:
+            lo = numpy.searchsorted(table["scan_id"], scan_id, side="left")
+            hi = numpy.searchsorted(table["scan_id"], scan_id, side="right")
+            return [uid.decode() for uid in table["uid"][lo:hi]]
+        return list(self.scan_ids.get(scan_id, []))
+
+    def snapshot_name(self, part):
+        return f"run_index-{self.catalog.replace('/', '_')}-{part}"
+
+    def save(self):
+        """Write the shared snapshot (integer scan_ids only)."""
+        with self._lock:
+            uids = self.uids
+            pairs = [
+                (scan_id, uid)
+                for scan_id, found in self.scan_ids.items()
+                if isinstance(scan_id, int)
+                for uid in found
+            ]
+        table = numpy.array(pairs, dtype=[("scan_id", "i8"), ("uid", uids.dtype)])
+        table = table[numpy.argsort(table["scan_id"], kind="stable")]
+        shared.write_array(self.snapshot_name("scan_ids"), table)
+        shared.write_array(self.snapshot_name("uids"), uids)
+
+    def reload(self):
+        """Use the shared snapshot, if it has changed."""
+        uids, mtime = shared.read_array(self.snapshot_name("uids"), self.snapshot)
+        if uids is None:
+            return
+        table, _ = shared.read_array(self.snapshot_name("scan_ids"))
+        if table is None:
+            return
+        with self._lock:
+            self.uids, self.scan_table, self.snapshot = uids, table, mtime
+        self.loaded = True
+
+    def reset(self):
+        """Forget the snapshot, before loading from MongoDB."""
+        with self._lock:
+            self.uids = numpy.array([], dtype="S36")
+            self.scan_ids, self.scan_table, self.snapshot = {}, None, None
+            self.last_id, self.counted, self.loaded = None, None, False
+
+
+def recheck_from(last_id):
+    """The _id after which to look for new runs, RECHECK seconds before last_id."""
+    from bson import ObjectId
+
+    if not isinstance(last_id, ObjectId):
+        return last_id
+    since = last_id.generation_time - datetime.timedelta(seconds=RECHECK)
+    return ObjectId.from_datetime(since)
+
+
+def follow(index, interval=POLL_INTERVAL):
+    """Load the index, then keep it current (in a thread)."""
+    collection = None
+    while True:
+        try:
+            if not shared.leader(index.snapshot_name("follow")):
+                index.reload()  # another worker follows MongoDB
+                time.sleep(interval)
+                continue
+            if index.scan_table is not None:
+                index.reset()  # that worker has ended, take over
+            if collection is None:
+                collection = catalogs.database(index.catalog)["run_start"]
+            t0 = time.perf_counter()
+            loading = not index.loaded
+            size = len(index)
+            index.update(collection)
+            if loading:
+                logger.info(
+                    "run index of %r: %d runs in %.1f s",
+                    index.catalog,
+                    len(index),
+                    time.perf_counter() - t0,
+                )
+            if shared.ENABLED and (loading or len(index) != size):
+                index.save()
+        except Exception as exc:
+            logger.warning("run index of %r: %s", index.catalog, exc)
+        time.sleep(interval)
+
+
+@router.on_event("startup")
+def start_indexes():
+    for catalog in catalogs.mongo_catalogs():
+        index = indexes[catalog] = RunIndex(catalog)
+        threading.Thread(target=follow, args=(index,), daemon=True).start()
+
+
+def get_index(catalog):
+    index = indexes.get(catalog)
+    if index is None:
+        raise HTTPException(status_code=404, detail=f"No run index for {catalog!r}")
+    if not index.loaded:
+        raise HTTPException(status_code=503, detail=f"Loading run index of {catalog!r}")
+    return index
+
+
+# {path}: the catalog, checked by SecureEntry as for tiled's own routes
+@router.get("/runs/{path}/uid/{prefix}")
+def runs_by_uid_prefix(
+    path: str,
+    prefix: str,
+    limit: int = Query(20, ge=1),
+    entry=SecureEntry(scopes=["read:metadata"]),
+):
+    t0 = time.perf_counter()
+    uids = get_index(path).by_prefix(prefix, limit=limit)
+    return dict(catalog=path, uids=uids, seconds=time.perf_counter() - t0)
+
+
+@router.get("/runs/{path}/scan_id/{scan_id}")
+def runs_by_scan_id(
+    path: str, scan_id: int, entry=SecureEntry(scopes=["read:metadata"])
+):
+    t0 = time.perf_counter()
+    uids = get_index(path).by_scan_id(scan_id)
+    return dict(catalog=path, uids=uids, seconds=time.perf_counter() - t0)
+
+
+@router.get("/runs/{path}/index")
+def run_index_summary(path: str, entry=SecureEntry(scopes=["read:metadata"])):
+    catalog = path
+    index = get_index(catalog)
+    table = index.scan_table
+    return dict(
+        catalog=catalog,
+        runs=len(index),
+        scan_ids=len(index.scan_ids if table is None else set(table["scan_id"])),
+        bytes=index.uids.nbytes,
+        snapshot=table is not None,  # shared by another worker
+    )
@@ -0,0 +1,233 @@
+"""
+Measure the server's throughput with 1, 2, 4, ... worker processes.
+
+A file tree of the synthetic corpus of ``benchmark.py`` is served (from a
+generated ``config.yml``) by ``server:build_app``, as ``start-tiled.sh``
+does, with each number of workers in turn.  Concurrent clients request
+CPU-bound routes (metadata of SPEC, MDA & image files, which parses them,
+and image arrays) for a fixed time.  Requests per second are reported::
+
+    python scaling.py
+    python scaling.py --workers 1 2 4 8 --concurrency 32 --seconds 30
+"""
+
+import benchmark
+import concurrent.futures
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = pathlib.Path(__file__).parent
+PORT = 8765
+TREE = "files"
+
+
+def write_config(directory, corpus_directory, trees=()):
+    """config.yml serving the corpus (and any other ``trees``); its path."""
+    import yaml
+
+    files_tree = dict(
+        path=TREE,
+        tree="files",
+        args=dict(
+            directory=str(corpus_directory),
+            key_from_filename="tiled.adapters.files:identity",
+            mimetype_detection_hook="custom:detect_mimetype",
+            mimetypes_by_file_ext=benchmark.MIMETYPES_BY_FILE_EXT,
+            readers_by_mimetype={
+                k: v
+                for k, v in benchmark.READERS_BY_MIMETYPE.items()
+                if not v.startswith("tiled.")  # tiled has its own
+            },
+        ),
+    )
+    path = pathlib.Path(directory) / "config.yml"
+    path.write_text(yaml.safe_dump(dict(trees=[files_tree, *trees])))
+    return path
+
+
+def start_server(config_file, workers=1, port=PORT, env=None):
+    """Start the server (as start-tiled.sh does), wait until it answers."""
+    import httpx
+
+    environment = dict(
+        os.environ,
+        TILED_CONFIG=str(config_file),
+        TILED_PUBLIC="1",
+        TILED_WORKERS=str(workers),
+        **(env or {}),
+    )
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "--factory",
+            "server:build_app",
+            "--app-dir",
+            str(HERE),
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--log-level",
+            "warning",
+        ],
+        env=environment,
+    )
+    deadline = time.time() + 300  # the file tree is scanned at startup
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with code {process.returncode}")
+        try:
+            # the tree is scanned (by one worker at least, the warm-up waits
+            # for the others)
+            response = httpx.get(f"http://localhost:{port}/api/v1/node/search/{TREE}")
+            if response.is_success:
+                return process
+        except httpx.TransportError:
+            pass
+        time.sleep(0.5)
+    stop_server(process)
+    raise TimeoutError("server did not start")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def server_rss(process):
+    """Resident memory (bytes) of the server and all its worker processes."""
+    pids, total = [process.pid], 0
+    while pids:
+        pid = pids.pop()
+        try:
+            status = pathlib.Path(f"/proc/{pid}/status").read_text()
+            for task in pathlib.Path(f"/proc/{pid}/task").iterdir():
+                pids += [int(p) for p in (task / "children").read_text().split()]
+        except OSError:
+            continue  # ended, or not Linux
+        for line in status.splitlines():
+            if line.startswith("VmRSS:"):
+                total += int(line.split()[1]) * 1024
+    return total
+
+
+def file_requests(corpus):
+    """(label, route) of CPU-bound requests of the corpus files."""
+    requests = []
+    for kind, path in corpus:
+        node = f"{TREE}/{path.name}"
+        label = kind.split()[0]
+        requests.append((f"metadata {label}", f"/api/v1/node/metadata/{node}"))
+        if label in ("bmp", "gif", "jpeg", "png", "tiff", "webp"):
+            requests.append(
+                (
+                    f"array {label}",
+                    f"/api/v1/array/full/{node}?format=application/octet-stream",
+                )
+            )
+    return requests
+
+
+def run_load(requests, concurrency=16, seconds=20, port=PORT):
+    """
+    Send the requests (in turn) from concurrent clients, for some seconds.
+
+    Returns a list of ``(label, seconds, status)``, one for each response,
+    and the time elapsed until the last response (seconds, at least those
+    asked: the requests sent until then are completed).
+    """
+    import httpx
+
+    results, lock = [], threading.Lock()
+    stop = time.time() + seconds
+
+    def client(i):
+        with httpx.Client(base_url=f"http://localhost:{port}", timeout=60) as http:
+            n = i
+            while time.time() < stop:
+                label, route = requests[n % len(requests)]
+                n += concurrency
+                t0 = time.perf_counter()
+                try:
+                    status = http.get(route).status_code
+                except httpx.TransportError:
+                    status = None
+                with lock:
+                    results.append((label, time.perf_counter() - t0, status))
+
+    t0 = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(client, range(concurrency)))
+    return results, time.perf_counter() - t0
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def main():
+    import argparse
+    import pyRestTable
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=20)
+    args = parser.parse_args()
+
+    table = pyRestTable.Table()
+    table.labels = "workers requests/s speedup p50,ms p95,ms errors RSS,MB".split()
+    with tempfile.TemporaryDirectory() as tempdir:
+        tempdir = pathlib.Path(tempdir)
+        corpus = benchmark.make_corpus(tempdir / "corpus")
+        config_file = write_config(tempdir, tempdir / "corpus")
+        requests = file_requests(corpus)
+        baseline = None
+        for workers in args.workers:
+            shared_dir = tempdir / f"shared_{workers}"
+            process = start_server(
+                config_file, workers, env=dict(TILED_SHARED_DIR=str(shared_dir))
+            )
+            try:
+                run_load(requests, args.concurrency, seconds=2)  # warm up
+                results, elapsed = run_load(requests, args.concurrency, args.seconds)
+                rss = server_rss(process)
+            finally:
+                stop_server(process)
+            latencies = [r[1] for r in results if r[2] == 200]
+            if len(latencies) == 0:
+                table.addRow((workers, 0, "-", "-", "-", len(results), "-"))
+                continue
+            throughput = len(latencies) / elapsed
+            baseline = baseline or throughput
+            table.addRow(
+                (
+                    workers,
+                    f"{throughput:.1f}",
+                    f"{throughput / baseline:.2f}",
+                    f"{1000 * percentile(latencies, 50):.1f}",
+                    f"{1000 * percentile(latencies, 95):.1f}",
+                    len(results) - len(latencies),
+                    f"{rss / 2**20:.0f}",
+                )
+            )
+            print(table.rows[-1], flush=True)
+    print(f"{os.cpu_count()} CPUs, {args.concurrency} clients, {len(requests)} routes")
+    print(table)
+
+
+if __name__ == "__main__":
+    main()
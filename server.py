@@ -0,0 +1,77 @@
+"""
+Build the tiled server app, with the additional routes of this project.
+
+Replaces ``tiled serve config`` (see ``start-tiled.sh``)::
+
+    TILED_CONFIG=config.yml uvicorn --factory server:build_app --port 8000
+"""
+
+import metrics
+import os
+import pathlib
+import unrecognized
+
+ROOT = pathlib.Path(__file__).parent
+CONFIG_FILE = pathlib.Path(os.environ.get("TILED_CONFIG", ROOT / "config.yml"))
+PUBLIC = os.environ.get("TILED_PUBLIC", "1") != "0"  # as `tiled serve config --public`
+
+
+def routers():
+    """Additional routes, all served below ``/api/v1``."""
+    import events
+    import facets
+    import federated
+    import handlers
+    import moved_metadata
+    import preview
+    import reader_routes
+    import reductions
+    import run_index
+
+    return [
+        events.router,
+        facets.router,
+        federated.router,
+        handlers.router,
+        moved_metadata.router,
+        preview.router,
+        reader_routes.router,
+        reductions.router,
+        run_index.router,
+    ]
+
+
+def install_file_hooks():
+    """Report the files seen by the mimetype detection hook to these routes."""
+    import custom
+    import events
+    import facets
+
+    for hook in (events.file_changed, facets.add_file):
+        if hook not in custom.file_hooks:
+            custom.file_hooks.append(hook)
+
+
+def build_app(config_file=None, public=None):
+    """Build the app as `tiled serve config` does, then add our routes."""
+    from tiled.config import construct_build_app_kwargs
+    from tiled.config import parse_configs
+    from tiled.server.app import build_app as build_tiled_app
+
+    config_file = pathlib.Path(config_file or CONFIG_FILE)
+    public = PUBLIC if public is None else public
+
+    config = parse_configs(config_file)
+    if public:
+        config.setdefault("authentication", {})["allow_anonymous_access"] = True
+    config.pop("uvicorn", None)  # uvicorn options are given on its command line
+
+    install_file_hooks()  # before the file trees are scanned
+    unrecognized.load()
+    app = build_tiled_app(
+        **construct_build_app_kwargs(config, source_filepath=config_file)
+    )
+    for router in routers():
+        app.include_router(router, prefix="/api/v1")
+    metrics.install_middleware(app)
+    return app
@@ -0,0 +1,202 @@
+"""
+State shared by the worker processes of the server.
+
+With ``WORKERS`` > 1 in ``start-tiled.sh``, uvicorn starts that many
+server processes (environment variable ``TILED_WORKERS``).  Each builds
+its own tree.  So that expensive work is done once, not once per worker:
+
+* mimetype detection results (by file, size & modification time) are kept
+  in a SQLite database (``STORE``), read by all workers;
+* one worker (the ``leader()`` of that task, by file lock) keeps each run
+  index current and writes snapshots of it (``write_array()``), which the
+  other workers map into memory (``read_array()``), shared by the OS;
+* the registry of unrecognized files (``unrecognized.py``) is merged
+  with that of the other workers when it is written;
+* the events pushed to clients (``events.py``) go through the store, so
+  that their ids (``Last-Event-ID``) are the same in all workers; one
+  worker (the leader) watches each catalog;
+* each worker writes its reader metrics (``metrics.py``) to a file
+  (``write_json()``), which the ``/readers/metrics`` route merges;
+* the preview images of files (``preview.py``) are already cached on disk.
+
+The adapters of the files (parsed by the readers) are not shared: they
+are Python objects, with open files, built by each worker when it serves
+the file.  A file may so be parsed once per worker.
+
+With one worker, nothing changes: the detection results and indexes are
+kept in memory, as before.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+
+DIRECTORY = pathlib.Path(os.environ.get("TILED_SHARED_DIR", "/tmp/tiled_shared"))
+WORKERS = int(os.environ.get("TILED_WORKERS", 1))
+ENABLED = WORKERS > 1
+STORE = DIRECTORY / "detected.sqlite"
+UNRECOGNIZED = ""  # detected mimetype of a file not recognized
+EVENTS_KEPT = 10_000  # per stream, older events are deleted
+
+logger = logging.getLogger(__name__)
+_local = threading.local()  # a SQLite connection per thread
+_locks = {}  # name: open lock file, while this process is the leader
+
+
+def connect():
+    """This thread's connection to the shared store."""
+    connection = getattr(_local, "connection", None)
+    if connection is None:
+        DIRECTORY.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(STORE, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")  # readers never wait
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS detected ("
+            " filename TEXT PRIMARY KEY, size INTEGER, mtime REAL, mimetype TEXT)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, stream TEXT, key TEXT,"
+            " content TEXT, UNIQUE (stream, key))"
+        )
+        _local.connection = connection
+    return connection
+
+
+def _signature(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None, None
+    return stat.st_size, stat.st_mtime
+
+
+def detected(filename):
+    """Mimetype detected (by any worker) for this unchanged file, or ``None``."""
+    if not ENABLED:
+        return None
+    row = (
+        connect()
+        .execute(
+            "SELECT size, mtime, mimetype FROM detected WHERE filename = ?",
+            (str(filename),),
+        )
+        .fetchone()
+    )
+    if row is None or tuple(row[:2]) != _signature(filename):
+        return None
+    return row[2]
+
+
+def remember(filename, mimetype):
+    """Keep the mimetype detected for this file, for all workers."""
+    if not ENABLED:
+        return
+    size, mtime = _signature(filename)
+    connect().execute(
+        "INSERT OR REPLACE INTO detected VALUES (?, ?, ?, ?)",
+        (str(filename), size, mtime, mimetype),
+    )
+
+
+def add_event(stream, key, content):
+    """Keep an event (JSON content) of the stream, once for its ``key``."""
+    connection = connect()
+    cursor = connection.execute(
+        "INSERT OR IGNORE INTO events (stream, key, content) VALUES (?, ?, ?)",
+        (stream, key, json.dumps(content, default=str)),
+    )
+    if cursor.rowcount == 1:
+        connection.execute(
+            "DELETE FROM events WHERE stream = ? AND id <= ?",
+            (stream, cursor.lastrowid - EVENTS_KEPT),
+        )
+
+
+def events_after(stream, last_id):
+    """List of ``(id, content)`` of the stream's events after ``last_id``."""
+    rows = connect().execute(
+        "SELECT id, content FROM events WHERE stream = ? AND id > ? ORDER BY id",
+        (stream, last_id),
+    )
+    return [(event_id, json.loads(content)) for event_id, content in rows]
+
+
+def last_event_id(stream):
+    row = connect().execute(
+        "SELECT MAX(id) FROM events WHERE stream = ?", (stream,)
+    ).fetchone()
+    return row[0] or 0
+
+
+def leader(name):
+    """Is this process the one (of all workers) to do the task ``name``?"""
+    if not ENABLED:
+        return True
+    if name in _locks:
+        return True
+    DIRECTORY.mkdir(parents=True, exist_ok=True)
+    lock_file = open(DIRECTORY / f"{name}.lock", "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _locks[name] = lock_file  # held until this process ends
+    logger.info("process %d leads %r", os.getpid(), name)
+    return True
+
+
+def write_array(name, array):
+    """Replace the shared snapshot of an array."""
+    import numpy
+
+    DIRECTORY.mkdir(parents=True, exist_ok=True)
+    path = DIRECTORY / f"{name}.npy"
+    temporary = path.with_name(f".{path.name}.{os.getpid()}")
+    with open(temporary, "wb") as f:
+        numpy.save(f, array)
+    os.replace(temporary, path)
+
+
+def read_array(name, since=None):
+    """
+    The shared snapshot of an array (memory-mapped), with its mtime.
+
+    Returns ``(None, since)`` if there is no snapshot newer than ``since``.
+    """
+    import numpy
+
+    path = DIRECTORY / f"{name}.npy"
+    try:
+        mtime = path.stat().st_mtime_ns
+        if since is not None and mtime <= since:
+            return None, since
+        return numpy.load(path, mmap_mode="r"), mtime
+    except (OSError, ValueError):
+        return None, since
+
+
+def write_json(name, content):
+    """Replace a shared file of JSON content."""
+    DIRECTORY.mkdir(parents=True, exist_ok=True)
+    path = DIRECTORY / f"{name}.json"
+    temporary = path.with_name(f".{path.name}.{os.getpid()}")
+    temporary.write_text(json.dumps(content))
+    os.replace(temporary, path)
+
+
+def read_json(pattern):
+    """The content of the shared JSON files with names like ``pattern``."""
+    found = []
+    for path in sorted(DIRECTORY.glob(f"{pattern}.json")):
+        try:
+            found.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            continue  # being replaced
+    return found
@@ -2,8 +2,9 @@
 
 from spec2nexus import spec
 from tiled.adapters.array import ArrayAdapter
-from tiled.adapters.mapping import MapAdapter
 import datetime
+import metadata_budget
+import metrics
 import numpy
 
 
@@ -11,6 +12,7 @@ EXTENSIONS = []  # no uniform standard exists, many common patterns
 MIMETYPE = "text/spec_data"
 
 
+@metrics.timed("metadata", MIMETYPE)
 def read_diffractometer_metadata(diffractometer):
     simple_attrs = """
         UB
@@ -77,9 +79,10 @@ def read_spec_scan(scan):
     except ValueError as exc:
         arrays = {}
         md = dict(ValueError=exc, disposition="skipping")
-    return MapAdapter(arrays, metadata=md)
+    return metadata_budget.map_adapter(arrays, md)
 
 
+@metrics.timed("read", MIMETYPE)
 def read_spec_data(filename):
     if not spec.is_spec_file_with_header(filename):
         raise spec.NotASpecDataFile(str(filename))
@@ -112,7 +115,7 @@ def read_spec_data(filename):
         for scan_number, scan in sdf.scans.items()
     }
     # fmt: on
-    return MapAdapter(scans, metadata=md)
+    return metadata_budget.map_adapter(scans, md)
 
 
 def main():
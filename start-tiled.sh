@@ -7,6 +7,9 @@ MY_DIR=$(realpath $(dirname $0))
 LOG_FILE="${MY_DIR}/logfile.txt"
 HOST=0.0.0.0
 PORT=8000
+# Server processes.  With more than one, the mimetype detection results and
+# run indexes are shared (see shared.py) in TILED_SHARED_DIR.
+WORKERS=1
 
 # export CONDA_BASE=/APSshare/miniconda/x86_64
 # source "${CONDA_BASE}/etc/profile.d/conda.sh"
@@ -14,9 +17,17 @@ PORT=8000
 # eval "$(micromamba shell hook --shell=)"
 # micromamba activate "${CONDA_ENV}"
 
-tiled serve config \
+# Same as `tiled serve config --public config.yml`, plus the routes in server.py.
+# (Set TILED_PUBLIC=0 to require an authentication token.)
+export TILED_CONFIG="${MY_DIR}/config.yml"
+export TILED_PUBLIC=1
+export TILED_WORKERS=${WORKERS}
+export TILED_SHARED_DIR="${MY_DIR}/.shared"
+
+uvicorn \
+    --factory server:build_app \
+    --app-dir "${MY_DIR}" \
     --port ${PORT} \
     --host ${HOST} \
-    --public \
-    "${MY_DIR}/config.yml" \
+    --workers ${WORKERS} \
     2>&1 | tee "${LOG_FILE}"
@@ -3,6 +3,8 @@
 from tiled.adapters.array import ArrayAdapter
 from tiled.adapters.mapping import MapAdapter
 import mda
+import metadata_budget
+import metrics
 
 EXTENSIONS = [".mda"]
 MIMETYPE = "application/x-mda"
@@ -14,6 +16,7 @@ def as_str(v):
     return v
 
 
+@metrics.timed("metadata", MIMETYPE)
 def read_mda_header(mda_obj):
     h_obj = mda_obj[0]
     file_md = {key: h_obj[key] for key in h_obj["ourKeys"] if key != "ourKeys"}
@@ -90,6 +93,7 @@ def read_mda_scan(scan):
     return MapAdapter(arrays, metadata=scan_md)
 
 
+@metrics.timed("read", MIMETYPE)
 def read_mda(filename):
     mda_obj = mda.readMDA(
         str(filename),
@@ -99,7 +103,7 @@ def read_mda(filename):
     )
     file_md = read_mda_header(mda_obj)
     scans = {f"S{scan.rank}": read_mda_scan(scan) for scan in mda_obj[1:]}
-    return MapAdapter(scans, metadata=file_md)
+    return metadata_budget.map_adapter(scans, file_md)
 
 
 def main():
@@ -0,0 +1,152 @@
+"""
+Registry of files that were not recognized, or could not be read.
+
+Replaces the ``/tmp/unrecognized_files.txt`` log: files are kept in memory
+(once each, with reason, size, first & last seen, and count) and written
+in batches to a bounded JSON file (``STORE``).  The server loads it
+(``load()``) before it scans the file trees, and writes it at exit; the
+registry is only written once loaded (not by ``benchmark.py``, say).
+
+The registry is also a cache for ``custom.detect_mimetype``: the mimetype
+recorded for a file is used again, without probing it, for as long as the
+file is not changed.
+
+Served by ``reader_routes.py``.
+"""
+
+import atexit
+import fcntl
+import json
+import os
+import pathlib
+import shared
+import threading
+import time
+
+STORE = pathlib.Path(
+    os.environ.get("TILED_UNRECOGNIZED_FILE", "/tmp/unrecognized_files.json")
+)
+MAX_ENTRIES = 10_000  # keep the most recently seen in STORE
+FLUSH_EVERY = 100  # changes
+FLUSH_INTERVAL = 30  # seconds
+
+_lock = threading.Lock()
+_records = {}  # str(path): dict
+_changes = 0
+_last_flush = time.time()
+_loaded = False
+
+
+def _signature(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None, None
+    return stat.st_size, stat.st_mtime
+
+
+def record(filename, reason, mimetype):
+    """
+    Register a file that was not recognized or could not be read.
+
+    ``reason`` is ``"unrecognized"`` or ``"unreadable"`` (as for the
+    ``reason`` query), followed by any detail.  ``mimetype`` is the one
+    to use the next time the file is seen (while it is not changed).
+    """
+    key = str(filename)
+    size, mtime = _signature(filename)
+    now = time.time()
+    with _lock:
+        entry = _records.get(key)
+        if entry is None or (entry["size"], entry["mtime"]) != (size, mtime):
+            entry = _records[key] = dict(
+                reason=reason,
+                mimetype=mimetype,
+                size=size,
+                mtime=mtime,
+                first_seen=now,
+                count=0,
+            )
+        entry.update(reason=reason, mimetype=mimetype, last_seen=now)
+        due = _seen(entry, now)
+    if due:
+        flush()
+
+
+def _seen(entry, now):
+    """Count the entry (with _lock held); is it time to flush?"""
+    global _changes
+    entry["count"] += 1
+    entry["last_seen"] = now
+    _changes += 1
+    return _changes >= FLUSH_EVERY or now - _last_flush >= FLUSH_INTERVAL
+
+
+def known(filename):
+    """Mimetype registered for this (unchanged) file, or ``None``."""
+    entry = _records.get(str(filename))
+    if entry is None:
+        return None
+    if (entry["size"], entry["mtime"]) != _signature(filename):
+        return None  # changed since then, look again
+    with _lock:
+        due = _seen(entry, time.time())
+    if due:
+        flush()
+    return entry["mimetype"]
+
+
+def flush():
+    """Write the registry (at most MAX_ENTRIES) to STORE."""
+    global _changes, _last_flush
+    with _lock:
+        if _changes == 0 or not _loaded:
+            return
+        items = sorted(_records.items(), key=lambda kv: kv[1]["last_seen"])
+        content = dict(items[-MAX_ENTRIES:])
+        _changes, _last_flush = 0, time.time()
+    try:
+        with open(STORE.with_name(f".{STORE.name}.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # other workers write STORE too
+            if shared.ENABLED:
+                for key, entry in _read().items():
+                    if key not in content or (
+                        content[key]["last_seen"] < entry["last_seen"]
+                    ):
+                        content[key] = entry
+            temporary = STORE.with_name(f".{STORE.name}.{os.getpid()}")
+            temporary.write_text(json.dumps(content))
+            os.replace(temporary, STORE)
+    except OSError:
+        pass  # not important enough to stop the server
+
+
+def _read():
+    try:
+        return json.loads(STORE.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def load():
+    """Read the registry from STORE, and write it at exit."""
+    global _loaded
+    content = _read()
+    with _lock:
+        for key, entry in content.items():
+            _records.setdefault(key, entry)
+        if not _loaded:
+            atexit.register(flush)
+        _loaded = True
+
+
+def query(reason=None, limit=None):
+    """Registered files (most recently seen first), optionally by reason."""
+    with _lock:
+        items = [
+            dict(filename=key, **entry)
+            for key, entry in _records.items()
+            if reason is None or entry["reason"].startswith(reason)
+        ]
+    items.sort(key=lambda item: item["last_seen"], reverse=True)
+    return items[:limit]
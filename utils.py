@@ -3,6 +3,8 @@ Support functions for this demo project.
 """
 
 import datetime
+import json
+import time
 
 import tiled.queries
 
@@ -58,6 +60,85 @@ def get_tiled_runs(cat, since=None, until=None, text=[], text_case=[], **keys):
     return cat
 
 
+def parse_sse(lines):
+    """Events (dictionaries) from the lines of a Server-Sent Events stream."""
+    event_id, data = None, []
+    for line in lines:
+        if line == "":
+            if len(data) > 0:
+                event = json.loads("\n".join(data))
+                event["id"] = event_id
+                yield event
+            data = []
+        elif line.startswith("id:"):
+            event_id = int(line[3:].strip())
+        elif line.startswith("data:"):
+            data.append(line[5:].strip())
+        # other lines: event type (also in the data), retry, comments
+
+
+def _get_events(node, route, params):
+    """Events pushed by the server, as they arrive (reconnects as needed)."""
+    http_client = node.context.http_client
+    uri = f"{node.context.api_uri}{route}"
+    headers = {}
+    while True:
+        try:
+            with http_client.stream(
+                "GET", uri, params=params, headers=headers, timeout=None
+            ) as response:
+                response.raise_for_status()
+                for event in parse_sse(response.iter_lines()):
+                    headers["Last-Event-ID"] = str(event["id"])
+                    yield event
+        except Exception as exc:
+            import httpx
+
+            if not isinstance(exc, httpx.TransportError):
+                raise
+        time.sleep(1)
+
+
+def node_path(node):
+    """Path of a tiled client node, such as ``"files/2023"``."""
+    return node.uri.split("/metadata/", 1)[1].strip("/")
+
+
+def get_run_events(cat, **keys):
+    """
+    Iterate over new (``start``) and ended (``stop``) runs, as they happen.
+
+    Each event is a dictionary with the run's summary (``event["run"]``).
+
+    Parameters
+
+    `cat` obj :
+        This is the catalog to be watched.
+        `Node` object returned by tiled.client.
+    `keys` dict :
+        Dictionary of metadata keys and values (of the start document)
+        to be matched.
+    """
+    params = [
+        ("key", f"{k}:{v if isinstance(v, str) else json.dumps(v)}")
+        for k, v in keys.items()
+    ]
+    yield from _get_events(cat, f"events/runs/{node_path(cat)}", params)
+
+
+def get_file_events(node):
+    """
+    Iterate over files added or modified in a file tree, as they happen.
+
+    Parameters
+
+    `node` obj :
+        File tree (or a directory of it) to be watched.
+        `Node` object returned by tiled.client.
+    """
+    yield from _get_events(node, "events/files", {"prefix": node_path(node)})
+
+
 def run_summary_table(runs):
     import pyRestTable
 